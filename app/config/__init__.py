@@ -4,14 +4,24 @@ Provides environment-specific configuration and secrets management
 """
 
 from .environment import env_config, Environment, EnvironmentConfig
-from .secrets import secrets_manager, SecretsManager
 
-# Lazy import to avoid initialization issues during testing
-def get_settings():
-    """Get settings instance (lazy loading)"""
-    from .settings import settings
-    return settings
+# Heavier submodules are imported on first use of their exports (PEP 562)
+_LAZY_EXPORTS = {
+    "get_settings": "settings",
+    "secrets_manager": "secrets",
+    "SecretsManager": "secrets",
+}
+
+def __getattr__(name: str):
+    module_name = _LAZY_EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+    value = getattr(import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
 
+# Lazy import to avoid initialization issues during testing
 def get_Settings_class():
     """Get Settings class (lazy loading)"""
     from .settings import Settings
@@ -0,0 +1,12 @@
+"""
+One-shot .env loading shared by the configuration modules
+"""
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1)
+def load_env_once() -> None:
+    """Load variables from .env exactly once per process"""
+    from dotenv import load_dotenv
+    load_dotenv()
@@ -0,0 +1,9 @@
+"""
+Filesystem locations shared by the configuration modules
+"""
+
+from pathlib import Path
+
+CONFIG_DIR = Path(__file__).parent
+ENVIRONMENTS_DIR = CONFIG_DIR / "environments"
+SECRETS_DIR = CONFIG_DIR / "secrets"
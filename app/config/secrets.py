@@ -5,19 +5,55 @@ Supports file-based and environment-based secrets
 
 import os
 import json
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, List, Optional, Set
 from pathlib import Path
-from cryptography.fernet import Fernet
-from app.config.environment import env_config
+from app.config._dotenv import load_env_once
+from app.config._paths import SECRETS_DIR
+
+# Set once the secrets directory has been created in this process
+_secrets_dir_ready = False
 
 class SecretsManager:
     """Secrets management for different environments"""
     
     def __init__(self):
-        self.secrets_dir = Path(__file__).parent / "secrets"
-        self.secrets_dir.mkdir(exist_ok=True)
+        global _secrets_dir_ready
+        if not _secrets_dir_ready:
+            SECRETS_DIR.mkdir(exist_ok=True)
+            _secrets_dir_ready = True
+        self.secrets_dir = SECRETS_DIR
+        # Bumped whenever the stored secret files change
+        self._version = 0
+        # Snapshot the environment once (after .env is loaded); the secrets
+        # directory listing is re-read only when its mtime changes
+        load_env_once()
+        self._environ: Dict[str, str] = dict(os.environ)
+        self._dir_mtime_ns: Optional[int] = None
+        self._dir_entries: Set[str] = set()
         self.encryption_key = self._get_encryption_key()
-        self.fernet = Fernet(self.encryption_key) if self.encryption_key else None
+        self.fernet = None
+        if self.encryption_key:
+            # cryptography is only imported when encryption is actually in use
+            from cryptography.fernet import Fernet
+            self.fernet = Fernet(self.encryption_key)
+        from app.config.environment import env_config
+        self._env_suffix = f"_{env_config.get_environment_name().upper()}"
+        self._build_resolvers()
+    
+    def _build_resolvers(self):
+        """Select the secret sources in lookup order; files are checked per key"""
+        resolvers: List[Callable[[str], Optional[str]]] = [self._from_env]
+        if self.fernet:
+            resolvers.append(self._from_encrypted_file)
+        resolvers.append(self._from_plain_file)
+        resolvers.append(self._from_env_suffixed)
+        self._resolvers = resolvers
+    
+    @property
+    def version(self) -> int:
+        """Changes whenever a secret file is written, deleted or added externally"""
+        self._stored_files()
+        return self._version
     
     def _get_encryption_key(self) -> Optional[bytes]:
         """Get encryption key from environment or generate one"""
@@ -26,7 +62,9 @@ class SecretsManager:
             return key.encode()
         
         # Generate key for development
-        if env_config.is_development():
+        from app.config.environment import env_config
+        if env_config.is_development:
+            from cryptography.fernet import Fernet
             key = Fernet.generate_key()
             print(f"Generated encryption key for development: {key.decode()}")
             return key
@@ -41,36 +79,66 @@ class SecretsManager:
         """Get path to encrypted secret file"""
         return self.secrets_dir / f"{secret_name}.enc"
     
-    def get_secret(self, secret_name: str, default: Optional[str] = None) -> Optional[str]:
-        """Get secret value from multiple sources"""
-        
-        # 1. Try environment variable first
-        env_value = os.getenv(secret_name.upper())
-        if env_value:
-            return env_value
-        
-        # 2. Try encrypted file
+    def _stored_files(self) -> Set[str]:
+        """File names in the secrets directory, re-listed only when it changes"""
+        try:
+            mtime_ns = os.stat(self.secrets_dir).st_mtime_ns
+        except OSError:
+            return set()
+        if mtime_ns != self._dir_mtime_ns:
+            if self._dir_mtime_ns is not None:
+                self._version += 1
+            self._dir_entries = set(os.listdir(self.secrets_dir))
+            self._dir_mtime_ns = mtime_ns
+        return self._dir_entries
+    
+    def _file_exists(self, path: Path) -> bool:
+        """Check file existence against the cached directory listing"""
+        return path.name in self._stored_files()
+    
+    def _secrets_changed(self):
+        """Refresh state derived from the stored secret files"""
+        self._version += 1
+        # Writes within one mtime tick would otherwise go unnoticed
+        self._dir_mtime_ns = None
+        self._stored_files()
+    
+    def _from_env(self, secret_name: str) -> Optional[str]:
+        """Read secret from environment variable"""
+        return self._environ.get(secret_name.upper()) or None
+    
+    def _from_encrypted_file(self, secret_name: str) -> Optional[str]:
+        """Read secret from encrypted file"""
         encrypted_path = self._get_encrypted_secret_file_path(secret_name)
-        if encrypted_path.exists() and self.fernet:
+        if self._file_exists(encrypted_path):
             try:
                 encrypted_data = encrypted_path.read_bytes()
                 decrypted_data = self.fernet.decrypt(encrypted_data)
                 return decrypted_data.decode()
             except Exception:
                 pass
-        
-        # 3. Try plain text file
+        return None
+    
+    def _from_plain_file(self, secret_name: str) -> Optional[str]:
+        """Read secret from plain text file"""
         secret_path = self._get_secret_file_path(secret_name)
-        if secret_path.exists():
+        if self._file_exists(secret_path):
             try:
                 return secret_path.read_text().strip()
             except Exception:
                 pass
-        
-        # 4. Try environment-specific secret
-        env_secret = os.getenv(f"{secret_name.upper()}_{env_config.get_environment_name().upper()}")
-        if env_secret:
-            return env_secret
+        return None
+    
+    def _from_env_suffixed(self, secret_name: str) -> Optional[str]:
+        """Read environment-specific secret variable"""
+        return self._environ.get(f"{secret_name.upper()}{self._env_suffix}") or None
+    
+    def get_secret(self, secret_name: str, default: Optional[str] = None) -> Optional[str]:
+        """Get secret value from the sources active in this process"""
+        for resolver in self._resolvers:
+            value = resolver(secret_name)
+            if value is not None:
+                return value
         
         return default
     
@@ -82,11 +150,13 @@ class SecretsManager:
                 encrypted_data = self.fernet.encrypt(value.encode())
                 encrypted_path = self._get_encrypted_secret_file_path(secret_name)
                 encrypted_path.write_bytes(encrypted_data)
+                self._secrets_changed()
                 return True
             else:
                 # Save plain text
                 secret_path = self._get_secret_file_path(secret_name)
                 secret_path.write_text(value)
+                self._secrets_changed()
                 return True
         except Exception:
             return False
@@ -101,6 +171,7 @@ class SecretsManager:
                 secret_path.unlink()
             if encrypted_path.exists():
                 encrypted_path.unlink()
+            self._secrets_changed()
             
             return True
         except Exception:
@@ -110,25 +181,48 @@ class SecretsManager:
         """List all available secrets"""
         secrets = {}
         
-        # Check plain text files
-        for file_path in self.secrets_dir.glob("*.txt"):
-            secret_name = file_path.stem
-            secrets[secret_name] = False  # Not encrypted
-        
-        # Check encrypted files
-        for file_path in self.secrets_dir.glob("*.enc"):
-            secret_name = file_path.stem
-            secrets[secret_name] = True  # Encrypted
+        # Single directory pass; encrypted files win over plain text ones
+        with os.scandir(self.secrets_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(".enc"):
+                    secrets[name[:-4]] = True  # Encrypted
+                elif name.endswith(".txt"):
+                    secrets.setdefault(name[:-4], False)  # Not encrypted
         
         return secrets
     
     def get_all_secrets(self) -> Dict[str, str]:
-        """Get all secrets as dictionary"""
+        """Get all file-based secrets as dictionary"""
         secrets = {}
-        secret_names = self.list_secrets().keys()
+        plain_paths: Dict[str, str] = {}
+        encrypted_paths: Dict[str, str] = {}
         
-        for secret_name in secret_names:
-            value = self.get_secret(secret_name)
+        with os.scandir(self.secrets_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(".enc"):
+                    encrypted_paths[name[:-4]] = entry.path
+                elif name.endswith(".txt"):
+                    plain_paths[name[:-4]] = entry.path
+        
+        # Encrypted files win over plain text ones, as in get_secret
+        if self.fernet:
+            for secret_name, path in encrypted_paths.items():
+                try:
+                    with open(path, "rb") as f:
+                        secrets[secret_name] = self.fernet.decrypt(f.read()).decode()
+                except Exception:
+                    pass
+        
+        for secret_name, path in plain_paths.items():
+            if secret_name in secrets:
+                continue
+            try:
+                with open(path) as f:
+                    value = f.read().strip()
+            except Exception:
+                continue
             if value:
                 secrets[secret_name] = value
         
@@ -146,6 +240,7 @@ class SecretsManager:
     
     def export_secrets_template(self, template_path: str) -> bool:
         """Export secrets template for documentation"""
+        from app.config.environment import env_config
         try:
             template = {
                 "environment": env_config.get_environment_name(),
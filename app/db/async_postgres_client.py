@@ -6,14 +6,138 @@ Provides async database operations with connection pooling and transaction suppo
 import asyncpg
 import logging
 import asyncio
-from typing import Optional, Dict, Any, List, Union
+import socket
+from typing import Optional, Dict, Any, List, Tuple, Union
 from contextlib import asynccontextmanager
+from datetime import datetime
+from uuid import UUID
+from urllib.parse import parse_qs, urlsplit, urlunsplit
 from app.config import get_settings
-from app.utils.retry import retry_with_exponential_backoff
+from app.utils.retry import calculate_delay, retry_with_exponential_backoff
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+# Only connection-level failures are worth retrying; SQL and constraint
+# errors are deterministic and re-raise on the first attempt. Socket errors
+# are listed individually: the bare ConnectionError raised when the pool is
+# not available is permanent and must not be retried.
+TRANSIENT_DB_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncio.TimeoutError,
+    ConnectionRefusedError,
+    ConnectionResetError,
+    socket.gaierror,
+)
+
+
+def is_transient_db_error(error: BaseException) -> bool:
+    """True for connection-level failures; asyncpg's client-side DataError subclasses InterfaceError but is deterministic"""
+    return isinstance(error, TRANSIENT_DB_ERRORS) and not isinstance(error, ValueError)
+
+
+# Hot queries live in constants so every call hands asyncpg the identical
+# string and hits its per-connection prepared statement cache.
+SQL_GET_BALANCE = "SELECT balance FROM balances WHERE user_id = $1"
+
+# Lock, upsert and record the transaction in one round trip. The WHERE guard
+# skips both writes when the charge would overdraw; the CHECK constraint on
+# balances covers a row inserted concurrently.
+SQL_UPDATE_BALANCE = """
+    WITH cur AS (
+        SELECT balance FROM balances WHERE user_id = $1 FOR UPDATE
+    ), calc AS (
+        SELECT COALESCE((SELECT balance FROM cur), 0) AS balance_before
+    ), upd AS (
+        INSERT INTO balances (user_id, balance)
+        SELECT $1, balance_before + $2::numeric FROM calc
+        WHERE balance_before + $2::numeric >= 0
+        ON CONFLICT (user_id)
+        DO UPDATE SET balance = balances.balance + $2::numeric
+        RETURNING balance
+    ), ins AS (
+        INSERT INTO transactions (user_id, amount, type, description)
+        SELECT $1, $2::numeric, CASE WHEN $2::numeric < 0 THEN 'debit' ELSE 'credit' END, $3
+        FROM upd
+        RETURNING id
+    )
+    SELECT calc.balance_before,
+           (SELECT balance FROM upd) AS balance_after,
+           (SELECT id FROM ins) AS transaction_id
+    FROM calc
+"""
+
+# Settles a debit the balance cannot cover: the balance drops to zero, the
+# row records what was actually charged ($2) and the unpaid remainder ($4)
+SQL_DEBIT_WITH_SHORTFALL = """
+    WITH upd AS (
+        INSERT INTO balances (user_id, balance)
+        VALUES ($1, 0)
+        ON CONFLICT (user_id) DO UPDATE SET balance = 0
+        RETURNING balance
+    ), ins AS (
+        INSERT INTO transactions (user_id, amount, type, description, unpaid)
+        SELECT $1, $2::numeric, 'debit', $3, $4::numeric FROM upd
+        RETURNING id
+    )
+    SELECT id FROM ins
+"""
+
+SQL_TRANSACTION_HISTORY = """
+    SELECT id, user_id, amount, unpaid, type, description, timestamp
+    FROM transactions
+    WHERE user_id = $1
+    ORDER BY timestamp DESC, id DESC
+    LIMIT $2 OFFSET $3
+"""
+
+# Keyset page: walks idx_transactions_user_timestamp from the cursor, so the
+# cost does not grow with page depth the way OFFSET does. id breaks ties
+# between rows sharing the boundary timestamp.
+SQL_TRANSACTION_HISTORY_BEFORE = """
+    SELECT id, user_id, amount, unpaid, type, description, timestamp
+    FROM transactions
+    WHERE user_id = $1 AND (timestamp, id) < ($2, $3)
+    ORDER BY timestamp DESC, id DESC
+    LIMIT $4
+"""
+
+# Sorts below every id, so a cursor without one means strictly older than before
+NIL_TRANSACTION_ID = UUID(int=0)
+
+SQL_BALANCE_INTEGRITY = """
+    SELECT
+        COALESCE((SELECT balance FROM balances WHERE user_id = $1), 0) as current_balance,
+        COALESCE(SUM(amount), 0) as calculated_balance,
+        COUNT(*) as transaction_count
+    FROM transactions
+    WHERE user_id = $1
+"""
+
+# DO NOTHING returns no row on conflict, so fetchval yields None
+SQL_CREATE_BALANCE = """
+    INSERT INTO balances (user_id, balance)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING true AS inserted
+"""
+
+SQL_USER_STATS = """
+    SELECT
+        COALESCE((SELECT balance FROM balances WHERE user_id = $1), 0) as current_balance,
+        COUNT(*) as total_transactions,
+        COUNT(*) FILTER (WHERE amount < 0) as debits,
+        COUNT(*) FILTER (WHERE amount > 0) as credits,
+        COALESCE(SUM(amount) FILTER (WHERE amount < 0), 0) as total_debits,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0), 0) as total_credits,
+        COALESCE(SUM(unpaid), 0) as total_unpaid,
+        MIN(timestamp) as first_transaction,
+        MAX(timestamp) as last_transaction
+    FROM transactions
+    WHERE user_id = $1
+"""
+
 
 class AsyncPostgresClient:
     """Async PostgreSQL client with connection pooling"""
@@ -25,24 +149,30 @@ class AsyncPostgresClient:
         self._pool: Optional[asyncpg.Pool] = None
         self._connection_attempts = 0
         self._max_connection_attempts = 3
+        self._connection_params = self._parse_connection_string()
+        self._init_lock = asyncio.Lock()
     
     async def initialize(self):
         """Initialize connection pool with retry logic"""
         if self._pool is None:
-            await self._initialize_with_retry()
+            async with self._init_lock:
+                # Another task may have built the pool while we waited
+                if self._pool is None:
+                    await self._initialize_with_retry()
     
     async def _initialize_with_retry(self):
         """Initialize connection pool with retry logic"""
         for attempt in range(self._max_connection_attempts):
             try:
-                # Parse connection string to add SSL settings for Supabase
-                connection_params = self._parse_connection_string()
-                
                 self._pool = await asyncpg.create_pool(
-                    **connection_params,
+                    **self._connection_params,
                     min_size=2,  # Reduced min_size for better stability
                     max_size=self.pool_size + self.max_overflow,
                     command_timeout=settings.timeouts.database_timeout,
+                    # Keep hot statements prepared for the life of the connection
+                    statement_cache_size=1024,
+                    max_cached_statement_lifetime=0,
+                    max_inactive_connection_lifetime=300,
                     server_settings={
                         'application_name': 'llm-gateway',
                         'timezone': 'UTC'
@@ -59,13 +189,18 @@ class AsyncPostgresClient:
                 self._connection_attempts = 0  # Reset attempts on success
                 return
                 
+            except (asyncpg.InvalidPasswordError, asyncpg.InvalidCatalogNameError) as e:
+                # Bad credentials or database name will not fix themselves
+                self._connection_attempts += 1
+                logger.error(f"Failed to initialize PostgreSQL connection pool, not retrying: {e}")
+                return
             except Exception as e:
                 self._connection_attempts += 1
                 logger.error(f"Failed to initialize PostgreSQL connection pool (attempt {attempt + 1}/{self._max_connection_attempts}): {e}")
                 
                 if attempt < self._max_connection_attempts - 1:
-                    wait_time = 2 ** attempt  # Exponential backoff
-                    logger.info(f"Retrying connection in {wait_time} seconds...")
+                    wait_time = calculate_delay(attempt)  # Jittered exponential backoff
+                    logger.info(f"Retrying connection in {wait_time:.2f} seconds...")
                     await asyncio.sleep(wait_time)
                 else:
                     logger.error("Max connection attempts reached. Using fallback mode.")
@@ -74,27 +209,18 @@ class AsyncPostgresClient:
     
     def _parse_connection_string(self) -> Dict[str, Any]:
         """Parse connection string and add SSL settings for Supabase"""
-        # For Supabase, we need to ensure SSL is properly configured
-        if 'supabase.co' in self.connection_string:
-            # Supabase requires SSL - add SSL parameters to connection string
-            if '?' in self.connection_string:
-                # Connection string already has parameters
-                ssl_params = '&sslmode=require'
-                if 'sslmode=' not in self.connection_string:
-                    connection_string = self.connection_string + ssl_params
-                else:
-                    connection_string = self.connection_string
-            else:
-                # No parameters in connection string
-                connection_string = self.connection_string + '?sslmode=require'
-            
-            return {
-                'dsn': connection_string
-            }
-        else:
+        parts = urlsplit(self.connection_string)
+        
+        # Supabase requires SSL - add sslmode unless the DSN already sets one
+        if 'supabase.co' in (parts.hostname or '') and 'sslmode' not in parse_qs(parts.query):
+            query = f"{parts.query}&sslmode=require" if parts.query else "sslmode=require"
             return {
-                'dsn': self.connection_string
+                'dsn': urlunsplit(parts._replace(query=query))
             }
+        
+        return {
+            'dsn': self.connection_string
+        }
     
     async def close(self):
         """Close connection pool"""
@@ -149,103 +275,129 @@ class AsyncPostgresClient:
             logger.error(f"Database transaction error: {e}")
             raise
     
-    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
     async def execute(self, query: str, *args) -> str:
         """Execute a command and return status with retry logic"""
         async with self.get_connection() as conn:
             return await conn.execute(query, *args)
     
-    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
     async def fetch(self, query: str, *args) -> List[asyncpg.Record]:
         """Fetch multiple rows with retry logic"""
         async with self.get_connection() as conn:
             return await conn.fetch(query, *args)
     
-    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
     async def fetchrow(self, query: str, *args) -> Optional[asyncpg.Record]:
         """Fetch a single row with retry logic"""
         async with self.get_connection() as conn:
             return await conn.fetchrow(query, *args)
     
-    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
     async def fetchval(self, query: str, *args) -> Any:
         """Fetch a single value with retry logic"""
         async with self.get_connection() as conn:
             return await conn.fetchval(query, *args)
     
+    @retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
+    async def read_fetchval(self, query: str, *args) -> Any:
+        """Fetch a single value for a read-only query straight from the pool"""
+        if self._pool is None:
+            await self.initialize()
+        
+        if self._pool is None:
+            raise ConnectionError("Database connection pool is not available. Check your database configuration.")
+        
+        # Pool.fetchval acquires and releases internally, skipping the
+        # get_connection context manager on the hottest read path
+        return await self._pool.fetchval(query, *args)
+    
     # Specific methods for billing operations
     async def get_balance(self, user_id: str) -> float:
         """Get user balance"""
-        query = """
-            SELECT balance FROM balances 
-            WHERE user_id = $1
-        """
-        result = await self.fetchval(query, user_id)
+        result = await self.read_fetchval(SQL_GET_BALANCE, user_id)
         return float(result) if result is not None else 0.0
     
     async def update_balance(self, user_id: str, amount: float, description: str) -> Dict[str, Any]:
         """Update user balance with transaction record"""
-        async with self.transaction() as conn:
-            # Get current balance
-            balance_query = "SELECT balance FROM balances WHERE user_id = $1"
-            current_balance = await conn.fetchval(balance_query, user_id)
-            balance_before = float(current_balance) if current_balance is not None else 0.0
-            
-            # Calculate new balance
-            balance_after = balance_before + amount
-            if balance_after < 0:
-                raise ValueError(f"Insufficient balance. Current: {balance_before}, Required: {abs(amount)}")
-            
-            # Update balance
-            upsert_query = """
-                INSERT INTO balances (user_id, balance) 
-                VALUES ($1, $2)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET balance = $2
-            """
-            await conn.execute(upsert_query, user_id, balance_after)
-            
-            # Insert transaction record
-            transaction_query = """
-                INSERT INTO transactions (user_id, amount, type, description)
-                VALUES ($1, $2, $3, $4)
-                RETURNING id
-            """
-            transaction_type = "debit" if amount < 0 else "credit"
-            transaction_id = await conn.fetchval(transaction_query, user_id, amount, transaction_type, description)
-            
-            return {
-                "balance_before": balance_before,
-                "balance_after": balance_after,
-                "transaction_id": transaction_id,
-                "success": True
-            }
-    
-    async def get_transaction_history(self, user_id: str, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
-        """Get transaction history for user with pagination"""
-        query = """
-            SELECT id, user_id, amount, type, description, timestamp
-            FROM transactions 
-            WHERE user_id = $1 
-            ORDER BY timestamp DESC 
-            LIMIT $2 OFFSET $3
+        try:
+            async with self.get_connection() as conn:
+                row = await conn.fetchrow(SQL_UPDATE_BALANCE, user_id, amount, description)
+        except asyncpg.CheckViolationError:
+            raise ValueError(f"Insufficient balance. Required: {abs(amount)}")
+        
+        balance_before = float(row["balance_before"])
+        if row["balance_after"] is None:
+            raise ValueError(f"Insufficient balance. Current: {balance_before}, Required: {abs(amount)}")
+        
+        return {
+            "balance_before": balance_before,
+            "balance_after": float(row["balance_after"]),
+            "transaction_id": row["transaction_id"],
+            "success": True
+        }
+
+    async def apply_balance_updates(self, items: List[Tuple[str, float, str]]) -> List[Dict[str, Any]]:
+        """Apply balance changes in order in one transaction, one guarded update and transaction row per item.
+        
+        Each item runs in its own savepoint: an item that fails deterministically
+        (bad user id, constraint) is rolled back alone and reported with "error".
+        Connection-level errors abort the whole batch and propagate.
         """
-        records = await self.fetch(query, user_id, limit, offset)
-        return [dict(record) for record in records]
+        results = []
+        async with self.transaction() as conn:
+            for user_id, amount, description in items:
+                try:
+                    async with conn.transaction():
+                        row = await conn.fetchrow(SQL_UPDATE_BALANCE, user_id, amount, description)
+                        shortfall = 0.0
+                        transaction_id = row["transaction_id"]
+                        if row["balance_after"] is None:
+                            # The row stays locked by FOR UPDATE, so charge what is left
+                            # and keep the rest in the transaction's unpaid column
+                            balance_before = row["balance_before"]
+                            shortfall = -amount - float(balance_before)
+                            transaction_id = await conn.fetchval(
+                                SQL_DEBIT_WITH_SHORTFALL, user_id, -balance_before, description, shortfall
+                            )
+                except Exception as e:
+                    if is_transient_db_error(e):
+                        raise
+                    results.append({"user_id": user_id, "amount": amount, "error": e})
+                    continue
+                results.append({
+                    "user_id": user_id,
+                    "amount": amount,
+                    "shortfall": shortfall,
+                    "transaction_id": transaction_id,
+                    "error": None
+                })
+        return results
+
+    async def get_transaction_history(
+        self,
+        user_id: str,
+        limit: int = 10,
+        offset: int = 0,
+        before: Optional[datetime] = None,
+        before_id: Optional[UUID] = None
+    ) -> List[Dict[str, Any]]:
+        """Get transaction history for user with pagination (keyset when before is given)"""
+        if before is not None:
+            records = await self.fetch(
+                SQL_TRANSACTION_HISTORY_BEFORE, user_id, before, before_id or NIL_TRANSACTION_ID, limit
+            )
+        else:
+            records = await self.fetch(SQL_TRANSACTION_HISTORY, user_id, limit, offset)
+        return list(map(dict, records))
     
     async def validate_balance_integrity(self, user_id: str) -> Dict[str, Any]:
         """Validate balance integrity by comparing with transaction history"""
-        # Get current balance
-        current_balance = await self.get_balance(user_id)
-        
-        # Calculate balance from transactions
-        query = "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = $1"
-        calculated_balance = await self.fetchval(query, user_id)
-        calculated_balance = float(calculated_balance) if calculated_balance is not None else 0.0
-        
-        # Get transaction count
-        count_query = "SELECT COUNT(*) FROM transactions WHERE user_id = $1"
-        transaction_count = await self.fetchval(count_query, user_id)
+        # Stored balance, transaction sum and count in one round trip
+        row = await self.fetchrow(SQL_BALANCE_INTEGRITY, user_id)
+        current_balance = float(row["current_balance"])
+        calculated_balance = float(row["calculated_balance"])
+        transaction_count = row["transaction_count"]
         
         is_valid = abs(current_balance - calculated_balance) < 0.001
         
@@ -260,49 +412,43 @@ class AsyncPostgresClient:
     
     async def create_user_balance(self, user_id: str, initial_balance: float = 0.0) -> bool:
         """Create initial balance for new user"""
-        query = """
-            INSERT INTO balances (user_id, balance)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO NOTHING
-        """
-        result = await self.execute(query, user_id, initial_balance)
-        return "INSERT" in result
+        inserted = await self.fetchval(SQL_CREATE_BALANCE, user_id, initial_balance)
+        return bool(inserted)
     
     async def get_user_stats(self, user_id: str) -> Dict[str, Any]:
         """Get user statistics"""
-        # Get balance
-        balance = await self.get_balance(user_id)
+        # Balance and transaction stats in one round trip
+        stats = await self.fetchrow(SQL_USER_STATS, user_id)
         
-        # Get transaction stats
-        stats_query = """
-            SELECT 
-                COUNT(*) as total_transactions,
-                COUNT(CASE WHEN amount < 0 THEN 1 END) as debits,
-                COUNT(CASE WHEN amount > 0 THEN 1 END) as credits,
-                COALESCE(SUM(CASE WHEN amount < 0 THEN amount END), 0) as total_debits,
-                COALESCE(SUM(CASE WHEN amount > 0 THEN amount END), 0) as total_credits,
-                MIN(timestamp) as first_transaction,
-                MAX(timestamp) as last_transaction
-            FROM transactions 
-            WHERE user_id = $1
-        """
-        stats = await self.fetchrow(stats_query, user_id)
+        if stats:
+            (current_balance, total_transactions, debits, credits,
+             total_debits, total_credits, total_unpaid, first_transaction, last_transaction) = stats
+            current_balance = float(current_balance)
+            total_debits = float(total_debits)
+            total_credits = float(total_credits)
+            total_unpaid = float(total_unpaid)
+        else:
+            total_transactions = debits = credits = 0
+            current_balance = total_debits = total_credits = total_unpaid = 0.0
+            first_transaction = last_transaction = None
         
         return {
             "user_id": user_id,
-            "current_balance": balance,
-            "total_transactions": stats["total_transactions"] if stats else 0,
-            "debits": stats["debits"] if stats else 0,
-            "credits": stats["credits"] if stats else 0,
-            "total_debits": float(stats["total_debits"]) if stats else 0.0,
-            "total_credits": float(stats["total_credits"]) if stats else 0.0,
-            "first_transaction": stats["first_transaction"] if stats else None,
-            "last_transaction": stats["last_transaction"] if stats else None
+            "current_balance": current_balance,
+            "total_transactions": total_transactions,
+            "debits": debits,
+            "credits": credits,
+            "total_debits": total_debits,
+            "total_credits": total_credits,
+            "total_unpaid": total_unpaid,
+            "first_transaction": first_transaction,
+            "last_transaction": last_transaction
         }
 
 
 # Global client instance
 _async_postgres_client: Optional[AsyncPostgresClient] = None
+_init_lock = asyncio.Lock()
 
 
 async def get_async_postgres_client() -> AsyncPostgresClient:
@@ -310,14 +456,18 @@ async def get_async_postgres_client() -> AsyncPostgresClient:
     global _async_postgres_client
     
     if _async_postgres_client is None:
-        # Parse database URL from settings
-        db_url = settings.database.url
-        _async_postgres_client = AsyncPostgresClient(
-            connection_string=db_url,
-            pool_size=settings.database.pool_size,
-            max_overflow=settings.database.max_overflow
-        )
-        await _async_postgres_client.initialize()
+        async with _init_lock:
+            if _async_postgres_client is None:
+                # Parse database URL from settings
+                db_url = settings.database.url
+                client = AsyncPostgresClient(
+                    connection_string=db_url,
+                    pool_size=settings.database.pool_size,
+                    max_overflow=settings.database.max_overflow
+                )
+                await client.initialize()
+                # Publish only once initialized so no caller sees a half-built client
+                _async_postgres_client = client
     
     return _async_postgres_client
 
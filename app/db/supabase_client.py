@@ -1,8 +1,5 @@
 # Handled in dependencies, but if needed:
-from supabase import create_client
-from app.config import get_settings
+from app.dependencies import get_supabase_client
 
-settings = get_settings()
-
-def get_client():
-    return create_client(settings.supabase_url, settings.supabase_key)
\ No newline at end of file
+# Same lazily built singleton as the FastAPI dependency
+get_client = get_supabase_client
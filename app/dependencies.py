@@ -5,9 +5,15 @@ from supabase import create_client, Client  # type: ignore
 from app.config import get_settings
 
 settings = get_settings()
+import asyncio
+import hashlib
 import logging
+import threading
+import time
 import httpx
-from typing import Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple
 
 logger = logging.getLogger("jwt")
 
@@ -17,8 +23,9 @@ def get_authorization_header() -> str:
     # In real usage, this would come from the request
     return "Bearer test_token"
 
+@lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
-    """Создает sync Supabase client для обратной совместимости"""
+    """Возвращает общий sync Supabase client для обратной совместимости"""
     if not settings.supabase_url or not settings.supabase_key:
         raise ValueError("Supabase URL and key are required")
         
@@ -36,6 +43,7 @@ async def get_supabase_client_async() -> Client:
     # для async HTTP запросов. Пока оставляем sync client, но готовим структуру
     return get_supabase_client()
 
+@lru_cache(maxsize=4)
 def _decode_jwt_secret(secret: str) -> str:
     """Decode base64 JWT secret to string"""
     try:
@@ -46,6 +54,59 @@ def _decode_jwt_secret(secret: str) -> str:
         # If it's not base64, return as is
         return secret
 
+# Settings are frozen, so the verification key can be decoded once. Passing
+# bytes spares PyJWT the str -> bytes conversion on every decode.
+_JWT_DECODED_SECRET: Optional[bytes] = (
+    _decode_jwt_secret(settings.security.jwt_secret).encode("utf-8") if settings.security.jwt_secret else None
+)
+
+# Supabase signs access tokens with the shared HS256 secret
+_JWT_ALGORITHMS = ["HS256"]
+
+# Issuers Supabase may put in "iss", with and without the /auth/v1 suffix
+_ALLOWED_ISSUERS = (
+    frozenset({settings.supabase_url, f"{settings.supabase_url}/auth/v1"}) if settings.supabase_url else frozenset()
+)
+
+# Decoder with the verification options preset, so decode() calls only
+# need the token, the key and the algorithm list
+_JWT_DECODER = jwt.PyJWT(options={
+    "verify_signature": True,
+    "verify_exp": True,
+    "verify_iat": True,
+    "verify_aud": False,  # Disable audience verification for Supabase tokens
+    "require": ["exp", "iat", "sub"]
+})
+
+# Verified tokens: blake2b(token) -> (user_id, expires_at), in LRU order.
+# Only digests are stored so the cache never holds bearer tokens.
+_JWT_CACHE_ENABLED = settings.security.jwt_cache_enabled
+_JWT_CACHE_MAX_SIZE = settings.security.jwt_cache_size
+_JWT_CACHE_TTL = settings.security.jwt_cache_ttl
+_jwt_cache: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+_jwt_cache_lock = threading.Lock()
+
+def _jwt_cache_get(key: bytes) -> Optional[str]:
+    """Return the cached user_id for a verified token if it has not expired"""
+    with _jwt_cache_lock:
+        entry = _jwt_cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del _jwt_cache[key]
+            return None
+        _jwt_cache.move_to_end(key)
+        return entry[0]
+
+def _jwt_cache_put(key: bytes, user_id: str, exp: float) -> None:
+    """Remember a verified token until its exp claim or the cache TTL, whichever is sooner"""
+    expires_at = min(float(exp), time.time() + _JWT_CACHE_TTL)
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (user_id, expires_at)
+        _jwt_cache.move_to_end(key)
+        if len(_jwt_cache) > _JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+
 def get_current_user(authorization: str = Header(...)):
     """
     Получает и верифицирует JWT токен для аутентификации пользователя.
@@ -64,7 +125,7 @@ def get_current_user(authorization: str = Header(...)):
         if not authorization.startswith("Bearer "):
             raise HTTPException(status_code=401, detail="Invalid authorization header format")
         
-        token: str = authorization.replace("Bearer ", "")
+        token: str = authorization[7:].strip()
         
         if not token:
             raise HTTPException(status_code=401, detail="Empty token")
@@ -80,22 +141,18 @@ def get_current_user(authorization: str = Header(...)):
         if not verify_signature:
             return token
         
+        cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest() if _JWT_CACHE_ENABLED else None
+        if cache_key is not None:
+            cached_user_id = _jwt_cache_get(cache_key)
+            if cached_user_id is not None:
+                return cached_user_id
+        
         try:
-            # Декодируем JWT секрет из base64
-            decoded_secret = _decode_jwt_secret(jwt_secret)
-            
             # Декодируем токен с верификацией
-            payload = jwt.decode(
+            payload = _JWT_DECODER.decode(
                 token, 
-                decoded_secret, 
-                algorithms=["HS256"],
-                options={
-                    "verify_signature": True,
-                    "verify_exp": True,
-                    "verify_iat": True,
-                    "verify_aud": False,  # Disable audience verification for Supabase tokens
-                    "require": ["exp", "iat", "sub"]
-                }
+                _JWT_DECODED_SECRET, 
+                algorithms=_JWT_ALGORITHMS
             )
             
             logger.debug(f"JWT payload decoded successfully: {payload.get('sub', 'unknown')}")
@@ -118,21 +175,16 @@ def get_current_user(authorization: str = Header(...)):
         # Дополнительные проверки для production
         if verify_signature:
             # Проверяем issuer если указан
-            if "iss" in payload:
-                expected_issuer = settings.supabase_url
-                actual_issuer = payload["iss"]
-                
-                # Handle both formats: with and without /auth/v1
-                if actual_issuer.endswith("/auth/v1"):
-                    actual_issuer = actual_issuer.replace("/auth/v1", "")
-                
-                if actual_issuer != expected_issuer:
-                    logger.warning(f"Token issuer mismatch: {payload['iss']} != {expected_issuer}")
+            issuer = payload.get("iss")
+            if issuer is not None and issuer not in _ALLOWED_ISSUERS:
+                logger.warning(f"Token issuer mismatch: {issuer} != {settings.supabase_url}")
             
             # Проверяем аудиторию если указана
             if "aud" in payload and payload["aud"] != "authenticated":
                 logger.warning(f"Token audience mismatch: {payload['aud']} != authenticated")
         
+        if cache_key is not None:
+            _jwt_cache_put(cache_key, user_id, payload["exp"])
         logger.info(f"User authenticated successfully: {user_id}")
         return user_id
         
@@ -149,4 +201,13 @@ async def get_current_user_async(authorization: Optional[str] = Header(None)):
     """
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header required")
-    return get_current_user(authorization)
\ No newline at end of file
+    
+    # Unverified tokens and cache hits are cheap and stay on the event loop;
+    # only a full signature verification is worth the hop to a worker thread
+    if not settings.security.jwt_verify:
+        return get_current_user(authorization)
+    if _JWT_CACHE_ENABLED and authorization.startswith("Bearer "):
+        cached_user_id = _jwt_cache_get(hashlib.blake2b(authorization[7:].strip().encode(), digest_size=16).digest())
+        if cached_user_id is not None:
+            return cached_user_id
+    return await asyncio.to_thread(get_current_user, authorization)
\ No newline at end of file
@@ -5,7 +5,9 @@ Provides comprehensive health monitoring for the LLM Gateway
 
 import time
 import asyncio
-from typing import Dict, Any, List, Optional
+import httpx
+from collections import Counter, deque
+from typing import Awaitable, Callable, Deque, Dict, Any, List, Optional, Tuple
 from enum import Enum
 from dataclasses import dataclass
 from app.utils.logging import get_logger
@@ -15,6 +17,13 @@ from app.services.litellm_service import get_circuit_breaker_status
 from app.monitoring.callbacks import get_monitoring_health
 from app.config import get_settings
 
+try:
+    import psutil
+    _HAS_PSUTIL = True
+except ImportError:
+    psutil = None
+    _HAS_PSUTIL = False
+
 settings = get_settings()
 
 logger = get_logger(__name__)
@@ -26,7 +35,7 @@ class HealthStatus(Enum):
     DEGRADED = "degraded"
     UNKNOWN = "unknown"
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class HealthCheckResult:
     """Result of a health check"""
     name: str
@@ -36,20 +45,122 @@ class HealthCheckResult:
     timestamp: float
     duration: float
 
+# Seconds a check result is reused before the check runs again, so that
+# frequent liveness/readiness probes do not hit every backend each time
+_CHECK_TTLS: Dict[str, float] = {
+    "redis": 2.0,
+    "database": 5.0,
+    "monitoring": 5.0,
+    "circuit_breakers": 1.0,
+    "llm_providers": 10.0,
+    "system_resources": 1.0,
+}
+
+# Seconds each check may run before it is reported as degraded, so one slow
+# backend cannot stall the whole probe response
+_CHECK_TIMEOUTS: Dict[str, float] = {
+    "redis": 1.0,
+    "database": 2.0,
+    "monitoring": 2.0,
+    "circuit_breakers": 1.0,
+    "llm_providers": 3.0,
+    "system_resources": 1.0,
+}
+
 class HealthChecker:
     """Comprehensive health checker for LLM Gateway"""
     
     def __init__(self):
         self.start_time = time.time()
-        self.health_history: List[HealthCheckResult] = []
+        # Last 100 results, stored already rendered for /health/history
+        self.health_history: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self._cache: Dict[str, Tuple[float, HealthCheckResult]] = {}
+        # Shared Supabase REST client, opened at app startup
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self._cache_locks: Dict[str, asyncio.Lock] = {name: asyncio.Lock() for name in _CHECK_TTLS}
+        self._all_checks_task: Optional["asyncio.Future[Dict[str, Any]]"] = None
+        # Registered checks in report order; TTLs and timeouts are keyed by name
+        self._checks: List[Tuple[str, Callable[[], Awaitable[HealthCheckResult]]]] = [
+            ("redis", self.check_redis_health),
+            ("database", self.check_database_health),
+            ("monitoring", self.check_monitoring_health),
+            ("circuit_breakers", self.check_circuit_breakers_health),
+        ]
+        # The provider check only reports static values, so it is opt-in
+        if settings.health_llm_provider_probe_enabled:
+            self._checks.append(("llm_providers", self.check_llm_providers_health))
+        self._checks.append(("system_resources", self.check_system_resources))
+        if _HAS_PSUTIL:
+            # Prime the counters so the first non-blocking sample is meaningful
+            psutil.cpu_percent(interval=None)
+    
+    async def _cached(self, name: str, check: Callable[[], Awaitable[HealthCheckResult]]) -> HealthCheckResult:
+        """Return a recent result for the named check, running it at most once per TTL"""
+        ttl = _CHECK_TTLS[name]
+        cached = self._cache.get(name)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        
+        async with self._cache_locks[name]:
+            # A concurrent probe may have refreshed the result while we waited
+            cached = self._cache.get(name)
+            if cached is not None and time.monotonic() - cached[0] < ttl:
+                return cached[1]
+            try:
+                result = await self._run_with_timeout(name, check)
+            except Exception as e:
+                self._record_history(self._exception_result(name, e))
+                raise
+            self._cache[name] = (time.monotonic(), result)
+            self._record_history(result)
+            return result
+    
+    def _record_history(self, result: HealthCheckResult) -> None:
+        """Add a freshly run check to /health/history (cache hits are not recorded)"""
+        self.health_history.append({
+            "name": result.name,
+            "status": result.status.value,
+            "message": result.message,
+            "timestamp": result.timestamp,
+            "duration_ms": round(result.duration * 1000, 2)
+        })
+    
+    @staticmethod
+    def _exception_result(name: str, error: Exception) -> HealthCheckResult:
+        """Report a check that raised as unhealthy"""
+        return HealthCheckResult(
+            name=name,
+            status=HealthStatus.UNHEALTHY,
+            message=f"Health check failed with exception: {str(error)}",
+            details={"error": str(error)},
+            timestamp=time.time(),
+            duration=0.0
+        )
+    
+    async def _run_with_timeout(self, name: str, check: Callable[[], Awaitable[HealthCheckResult]]) -> HealthCheckResult:
+        """Run a check within its time budget, reporting a timeout as degraded"""
+        timeout = _CHECK_TIMEOUTS[name]
+        start_time = time.perf_counter()
+        try:
+            return await asyncio.wait_for(check(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Health check {name} timed out after {timeout}s")
+            return HealthCheckResult(
+                name=name,
+                status=HealthStatus.DEGRADED,
+                message="check timed out",
+                details={"timeout_seconds": timeout},
+                timestamp=time.time(),
+                duration=time.perf_counter() - start_time
+            )
     
     async def check_redis_health(self) -> HealthCheckResult:
         """Check Redis connection health"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             # Check if Redis is configured
             if not settings.rate_limit_storage == "redis":
-                duration = time.time() - start_time
+                duration = time.perf_counter() - start_time
                 return HealthCheckResult(
                     name="redis",
                     status=HealthStatus.HEALTHY,
@@ -60,7 +171,7 @@ class HealthChecker:
                 )
             
             health_data = redis_client.health_check()
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             
             if health_data.get("connected", False):
                 status = HealthStatus.HEALTHY
@@ -78,7 +189,7 @@ class HealthChecker:
                 duration=duration
             )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"Redis health check failed: {e}")
             return HealthCheckResult(
                 name="redis",
@@ -89,14 +200,46 @@ class HealthChecker:
                 duration=duration
             )
     
+    async def open_http_client(self) -> None:
+        """Create the pooled Supabase REST client used by the database probe"""
+        if self.http_client is not None or not settings.supabase_url or not settings.supabase_key:
+            return
+        self.http_client = httpx.AsyncClient(
+            base_url=settings.supabase_url,
+            http2=True,
+            headers={"apikey": settings.supabase_key, "Authorization": f"Bearer {settings.supabase_key}"},
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(5.0, connect=1.0)
+        )
+    
+    async def close_http_client(self) -> None:
+        """Close the shared Supabase REST client"""
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+    
+    @staticmethod
+    def _ping_database() -> None:
+        """Run the blocking Supabase connectivity query"""
+        get_supabase_client().table("balances").select("user_id").limit(1).execute()
+    
     async def check_database_health(self) -> HealthCheckResult:
         """Check database connection health"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
-            db = get_supabase_client()
-            # Simple query to test connection
-            result = db.table("balances").select("count", count="exact").limit(1).execute()
-            duration = time.time() - start_time
+            # Fetch at most one key without count="exact", which would make
+            # PostgREST run a full COUNT(*) over balances on every probe. The
+            # sync client blocks (including its first construction), so run
+            # it in a thread where the per-check timeout can still fire.
+            if self.http_client is not None:
+                # Same query over the pooled keep-alive client, reusing TLS sessions
+                response = await self.http_client.get(
+                    "/rest/v1/balances", params={"select": "user_id", "limit": "1"}
+                )
+                response.raise_for_status()
+            else:
+                await asyncio.to_thread(self._ping_database)
+            duration = time.perf_counter() - start_time
             
             return HealthCheckResult(
                 name="database",
@@ -107,7 +250,7 @@ class HealthChecker:
                 duration=duration
             )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"Database health check failed: {e}")
             return HealthCheckResult(
                 name="database",
@@ -120,10 +263,10 @@ class HealthChecker:
     
     async def check_monitoring_health(self) -> HealthCheckResult:
         """Check monitoring systems health"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             monitoring_data = get_monitoring_health()
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             
             # Check if all monitoring components are healthy
             langfuse_healthy = monitoring_data.get("langfuse", {}).get("status") == "healthy"
@@ -148,7 +291,7 @@ class HealthChecker:
                 duration=duration
             )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"Monitoring health check failed: {e}")
             return HealthCheckResult(
                 name="monitoring",
@@ -161,10 +304,10 @@ class HealthChecker:
     
     async def check_circuit_breakers_health(self) -> HealthCheckResult:
         """Check circuit breakers health"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             circuit_breakers = get_circuit_breaker_status()
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             
             # Count open circuit breakers
             open_breakers = sum(1 for cb in circuit_breakers.values() if cb.get("state") == "open")
@@ -193,7 +336,7 @@ class HealthChecker:
                 duration=duration
             )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"Circuit breakers health check failed: {e}")
             return HealthCheckResult(
                 name="circuit_breakers",
@@ -206,7 +349,7 @@ class HealthChecker:
     
     async def check_llm_providers_health(self) -> HealthCheckResult:
         """Check LLM providers health (simulated)"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             # This is a simulated check - in production you might want to make actual API calls
             providers = {
@@ -214,7 +357,7 @@ class HealthChecker:
                 "anthropic": {"status": "healthy", "response_time_ms": 45},
                 "google": {"status": "healthy", "response_time_ms": 60}
             }
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             
             healthy_providers = sum(1 for p in providers.values() if p["status"] == "healthy")
             total_providers = len(providers)
@@ -238,7 +381,7 @@ class HealthChecker:
                 duration=duration
             )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"LLM providers health check failed: {e}")
             return HealthCheckResult(
                 name="llm_providers",
@@ -251,16 +394,26 @@ class HealthChecker:
     
     async def check_system_resources(self) -> HealthCheckResult:
         """Check system resources (memory, CPU)"""
-        start_time = time.time()
+        start_time = time.perf_counter()
+        if not _HAS_PSUTIL:
+            duration = time.perf_counter() - start_time
+            return HealthCheckResult(
+                name="system_resources",
+                status=HealthStatus.UNKNOWN,
+                message="System resources check not available (psutil not installed)",
+                details={"note": "Install psutil for detailed system monitoring"},
+                timestamp=time.time(),
+                duration=duration
+            )
+        
         try:
-            import psutil
-            
             # Get system metrics
             memory = psutil.virtual_memory()
-            cpu_percent = psutil.cpu_percent(interval=0.1)
+            # Non-blocking: CPU usage since the previous sample
+            cpu_percent = psutil.cpu_percent(interval=None)
             disk = psutil.disk_usage('/')
             
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             
             # Determine health based on thresholds
             memory_healthy = memory.percent < 90
@@ -291,19 +444,8 @@ class HealthChecker:
                 timestamp=time.time(),
                 duration=duration
             )
-        except ImportError:
-            # psutil not available
-            duration = time.time() - start_time
-            return HealthCheckResult(
-                name="system_resources",
-                status=HealthStatus.UNKNOWN,
-                message="System resources check not available (psutil not installed)",
-                details={"note": "Install psutil for detailed system monitoring"},
-                timestamp=time.time(),
-                duration=duration
-            )
         except Exception as e:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(f"System resources health check failed: {e}")
             return HealthCheckResult(
                 name="system_resources",
@@ -316,90 +458,92 @@ class HealthChecker:
     
     async def run_all_health_checks(self) -> Dict[str, Any]:
         """Run all health checks and return comprehensive status"""
-        start_time = time.time()
+        # Single-flight: concurrent callers share the one run in progress
+        task = self._all_checks_task
+        if task is None:
+            task = asyncio.ensure_future(self._run_all_health_checks())
+            self._all_checks_task = task
+            task.add_done_callback(self._clear_all_checks_task)
+        # Shield so a cancelled caller does not cancel the run for the others;
+        # each caller gets its own top-level dict to add fields to
+        return dict(await asyncio.shield(task))
+    
+    def _clear_all_checks_task(self, task: "asyncio.Future[Dict[str, Any]]") -> None:
+        if self._all_checks_task is task:
+            self._all_checks_task = None
+    
+    async def _run_all_health_checks(self) -> Dict[str, Any]:
+        start_time = time.perf_counter()
         
         # Run all health checks concurrently
-        checks = [
-            self.check_redis_health(),
-            self.check_database_health(),
-            self.check_monitoring_health(),
-            self.check_circuit_breakers_health(),
-            self.check_llm_providers_health(),
-            self.check_system_resources()
-        ]
+        results = await asyncio.gather(
+            *(self._cached(name, check) for name, check in self._checks),
+            return_exceptions=True
+        )
         
-        results = await asyncio.gather(*checks, return_exceptions=True)
-        
-        # Process results
+        # Process results, rendering and counting them in the same pass
         health_results = []
-        for i, result in enumerate(results):
+        check_details: Dict[str, Dict[str, Any]] = {}
+        status_counts: Counter = Counter()
+        for (name, _), result in zip(self._checks, results):
             if isinstance(result, Exception):
                 # Handle exceptions from health checks
-                health_results.append(HealthCheckResult(
-                    name=f"check_{i}",
-                    status=HealthStatus.UNHEALTHY,
-                    message=f"Health check failed with exception: {str(result)}",
-                    details={"error": str(result)},
-                    timestamp=time.time(),
-                    duration=0.0
-                ))
-            else:
-                health_results.append(result)
+                result = self._exception_result(name, result)
+            health_results.append(result)
+            status = result.status
+            status_counts[status] += 1
+            check_details[result.name] = {
+                "status": status.value,
+                "message": result.message,
+                "details": result.details,
+                "duration_ms": round(result.duration * 1000, 2)
+            }
         
-        # Store in history (keep last 100 results)
-        self.health_history.extend(health_results)
-        if len(self.health_history) > 100:
-            self.health_history = self.health_history[-100:]
         
-        # Determine overall status
-        overall_status = self._determine_overall_status(health_results)
-        total_duration = time.time() - start_time
+        overall_status = self._determine_overall_status(health_results, status_counts)
+        total_duration = time.perf_counter() - start_time
         
         return {
             "status": overall_status.value,
             "timestamp": time.time(),
             "uptime_seconds": time.time() - self.start_time,
-            "checks": {
-                result.name: {
-                    "status": result.status.value,
-                    "message": result.message,
-                    "details": result.details,
-                    "duration_ms": round(result.duration * 1000, 2)
-                }
-                for result in health_results
-            },
+            "checks": check_details,
             "summary": {
                 "total_checks": len(health_results),
-                "healthy_checks": sum(1 for r in health_results if r.status == HealthStatus.HEALTHY),
-                "degraded_checks": sum(1 for r in health_results if r.status == HealthStatus.DEGRADED),
-                "unhealthy_checks": sum(1 for r in health_results if r.status == HealthStatus.UNHEALTHY),
+                "healthy_checks": status_counts[HealthStatus.HEALTHY],
+                "degraded_checks": status_counts[HealthStatus.DEGRADED],
+                "unhealthy_checks": status_counts[HealthStatus.UNHEALTHY],
                 "total_duration_ms": round(total_duration * 1000, 2)
             }
         }
     
-    def _determine_overall_status(self, results: List[HealthCheckResult]) -> HealthStatus:
+    def _determine_overall_status(
+        self,
+        results: List[HealthCheckResult],
+        status_counts: Optional[Counter] = None
+    ) -> HealthStatus:
         """Determine overall health status based on individual check results"""
         if not results:
             return HealthStatus.UNKNOWN
         
-        unhealthy_count = sum(1 for r in results if r.status == HealthStatus.UNHEALTHY)
-        degraded_count = sum(1 for r in results if r.status == HealthStatus.DEGRADED)
+        if status_counts is None:
+            status_counts = Counter(r.status for r in results)
         
-        if unhealthy_count > 0:
+        if status_counts[HealthStatus.UNHEALTHY] > 0:
             return HealthStatus.UNHEALTHY
-        elif degraded_count > 0:
+        elif status_counts[HealthStatus.DEGRADED] > 0:
             return HealthStatus.DEGRADED
         else:
             return HealthStatus.HEALTHY
     
     async def readiness_check(self) -> Dict[str, Any]:
         """Readiness probe - check if service is ready to handle requests"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         # For readiness, we focus on critical dependencies
         critical_checks = [
-            self.check_database_health(),
-            self.check_monitoring_health()
+            self._cached("database", self.check_database_health),
+            self._cached("monitoring", self.check_monitoring_health)
         ]
         
         results = await asyncio.gather(*critical_checks, return_exceptions=True)
@@ -420,7 +564,7 @@ class HealthChecker:
                 if result.status == HealthStatus.UNHEALTHY:
                     ready = False
         
-        duration = time.time() - start_time
+        duration = time.perf_counter() - start_time
         
         return {
             "ready": ready,
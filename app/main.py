@@ -1,32 +1,41 @@
+import asyncio
+import gzip
 import time
+import itertools
 import os
-from fastapi import FastAPI  # type: ignore
+import orjson
+from contextlib import asynccontextmanager
+from functools import wraps
+from typing import Any
+from fastapi import FastAPI, Request  # type: ignore
 from app.routers import api
-from app.middleware.rate_limit import limiter, get_limiter
+from app.middleware.rate_limit import limiter, ProbeExemptSlowAPIMiddleware, STORAGE_URI as RATE_LIMIT_STORAGE_URI
+from app.middleware.request_size import RequestSizeLimitMiddleware
 from slowapi.errors import RateLimitExceeded  # type: ignore
 from app.utils.logging import logger
 from app.utils.redis_client import redis_client
 from app.services.litellm_service import get_circuit_breaker_status
 from app.monitoring.callbacks import get_monitoring_health
-from app.monitoring.prometheus_metrics import prometheus_metrics
+from app.monitoring.langfuse_client import langfuse_client
+from app.monitoring.prometheus_metrics import prometheus_metrics, METRICS_CACHE_TTL
 from app.health import health_checker
-from slowapi.middleware import SlowAPIMiddleware  # type: ignore
+from app.utils.cache import async_ttl_cache
 from fastapi.responses import JSONResponse, Response  # type: ignore
 from app.config import get_settings
 from app.db.async_postgres_client import get_async_postgres_client, close_async_postgres_client
+from app.services.billing_service import balance_batcher
 
-# Initialize Sentry for error tracking
-try:
-    import sentry_sdk
-    from sentry_sdk.integrations.fastapi import FastApiIntegration
-    from sentry_sdk.integrations.redis import RedisIntegration
-    from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
-    
-    # Only initialize Sentry if DSN is provided
-    sentry_dsn = os.getenv("SENTRY_DSN")
-    if sentry_dsn:
+# Initialize Sentry for error tracking (integrations are only imported when a DSN is set)
+SENTRY_DSN = os.getenv("SENTRY_DSN")
+if SENTRY_DSN:
+    try:
+        import sentry_sdk
+        from sentry_sdk.integrations.fastapi import FastApiIntegration
+        from sentry_sdk.integrations.redis import RedisIntegration
+        from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+        
         sentry_sdk.init(
-            dsn=sentry_dsn,
+            dsn=SENTRY_DSN,
             integrations=[
                 FastApiIntegration(),
                 RedisIntegration(),
@@ -38,37 +47,34 @@ try:
             release=os.getenv("APP_VERSION", "1.0.0"),
         )
         logger.info("Sentry initialized successfully")
-    else:
-        logger.info("Sentry DSN not provided, skipping Sentry initialization")
-except ImportError:
-    logger.warning("Sentry SDK not installed, skipping Sentry initialization")
+    except ImportError:
+        logger.warning("Sentry SDK not installed, skipping Sentry initialization")
+else:
+    logger.info("Sentry DSN not provided, skipping Sentry initialization")
 
 settings = get_settings()
 
-app = FastAPI()
-
-app.state.limiter = limiter
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_handler(request, exc):
-    return JSONResponse(content={"detail": "Rate limit exceeded"}, status_code=429)
+async def _init_health_http_client():
+    """Open the pooled HTTP client used by the database health probe"""
+    try:
+        await health_checker.open_http_client()
+    except Exception as e:
+        logger.error(f"Health check HTTP client initialization error: {e}")
 
-app.include_router(api.router)
+async def _init_redis():
+    """Check the Redis connection when it backs rate limiting"""
+    if settings.rate_limit_storage != "redis":
+        return
+    try:
+        if await asyncio.to_thread(redis_client.is_connected):
+            logger.info("Redis connected successfully")
+        else:
+            logger.warning("Redis connection failed, using memory storage")
+    except Exception as e:
+        logger.error(f"Redis initialization error: {e}")
 
-@app.on_event("startup")
-async def startup():
-    logger.info("Application startup complete.")
-    
-    # Initialize Redis connection
-    if settings.rate_limit_storage == "redis":
-        try:
-            if redis_client.is_connected():
-                logger.info("Redis connected successfully")
-            else:
-                logger.warning("Redis connection failed, using memory storage")
-        except Exception as e:
-            logger.error(f"Redis initialization error: {e}")
-    
-    # Initialize PostgreSQL connection
+async def _init_postgres():
+    """Create the PostgreSQL connection pool"""
     try:
         db_client = await get_async_postgres_client()
         # Check if the pool was actually created
@@ -80,48 +86,110 @@ async def startup():
         logger.error(f"PostgreSQL initialization error: {e}")
         logger.warning("Application will continue with database fallback mode")
 
-@app.on_event("shutdown")
-async def shutdown():
-    """Graceful shutdown with proper cleanup"""
-    logger.info("Starting graceful shutdown...")
-    
+async def _close_redis():
     try:
-        # Close Redis connection
         logger.info("Closing Redis connection...")
-        redis_client.close()
+        await asyncio.to_thread(redis_client.close)
         logger.info("Redis connection closed successfully")
     except Exception as e:
         logger.error(f"Error closing Redis connection: {e}")
-    
+
+async def _close_postgres():
     try:
-        # Close PostgreSQL connection
         logger.info("Closing PostgreSQL connection pool...")
         await close_async_postgres_client()
         logger.info("PostgreSQL connection pool closed successfully")
     except Exception as e:
         logger.error(f"Error closing PostgreSQL connection: {e}")
-    
-    # Close any other resources if needed
+
+async def _close_langfuse():
+    try:
+        # Drain queued Langfuse events, then release its HTTP connections
+        await asyncio.to_thread(langfuse_client.close)
+    except Exception as e:
+        logger.error(f"Error closing Langfuse client: {e}")
+
+async def _close_health_http_client():
     try:
-        # Close any background tasks or workers
-        logger.info("Cleaning up background resources...")
-        # Add any additional cleanup here
+        await health_checker.close_http_client()
     except Exception as e:
-        logger.error(f"Error during background cleanup: {e}")
+        logger.error(f"Error closing health check HTTP client: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup and graceful shutdown; independent resources are handled concurrently"""
+    await asyncio.gather(_init_health_http_client(), _init_redis(), _init_postgres())
+    balance_batcher.start()
+    logger.info("Application startup complete.")
+    
+    yield
     
+    logger.info("Starting graceful shutdown...")
+    # Queued charges must be written before the PostgreSQL pool closes
+    try:
+        await balance_batcher.stop()
+    except Exception as e:
+        logger.error(f"Error writing queued balance updates: {e}")
+    await asyncio.gather(_close_redis(), _close_postgres(), _close_langfuse(), _close_health_http_client())
     logger.info("Graceful shutdown completed")
 
-app.add_middleware(SlowAPIMiddleware)
+app = FastAPI(lifespan=lifespan)
+
+app.state.limiter = limiter
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_handler(request, exc):
+    return JSONResponse(content={"detail": "Rate limit exceeded"}, status_code=429)
+
+app.include_router(api.router)
+
+app.add_middleware(ProbeExemptSlowAPIMiddleware)
+# Added last so it runs first: oversized bodies are refused before rate limiting
+app.add_middleware(RequestSizeLimitMiddleware)
+
+# Seconds a rendered health response is reused, coalescing duplicate probes
+HEALTH_RESPONSE_TTL = 2.0
+
+def _json_response(body: bytes) -> Response:
+    """Wrap pre-rendered JSON bytes; FastAPI passes a Response through untouched"""
+    return Response(content=body, media_type="application/json")
+
+def _render_json(payload: Any) -> bytes:
+    """Serialize a plain-JSON payload with orjson (the options ORJSONResponse used)"""
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+def cached_json_response(ttl: float):
+    """Cache an endpoint's rendered JSON body for ttl seconds, building a fresh Response per request"""
+    def decorator(func):
+        # Only the bytes are shared; middleware may mutate each Response's headers
+        @async_ttl_cache(ttl=ttl)
+        @wraps(func)
+        async def render() -> bytes:
+            return _render_json(await func())
+        
+        @wraps(func)
+        async def endpoint() -> Response:
+            return _json_response(await render())
+        
+        return endpoint
+    
+    return decorator
+
+# Liveness probe endpoint
+@app.get("/livez")
+async def liveness_probe():
+    """Liveness probe - answers without touching any dependency"""
+    return {"status": "ok"}
 
 # Health check endpoint
 @app.get("/health")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def health_check():
     """Comprehensive health check endpoint"""
     try:
         health_data = await health_checker.run_all_health_checks()
         
         # Add legacy fields for backward compatibility
-        health_data["rate_limit_storage"] = get_limiter()._storage_uri if hasattr(get_limiter(), '_storage_uri') else "unknown"
+        health_data["rate_limit_storage"] = RATE_LIMIT_STORAGE_URI
         health_data["retry_enabled"] = settings.retry_enabled
         health_data["circuit_breaker_enabled"] = settings.circuit_breaker_enabled
         
@@ -138,7 +206,7 @@ async def health_check():
 @app.get("/health/circuit-breakers")
 async def circuit_breaker_status():
     """Get status of all circuit breakers"""
-    return {
+    return _json_response(_render_json({
         "circuit_breakers": get_circuit_breaker_status(),
         "retry_config": {
             "enabled": settings.retry_enabled,
@@ -153,33 +221,52 @@ async def circuit_breaker_status():
             "failure_threshold": settings.circuit_breaker_failure_threshold,
             "recovery_timeout": settings.circuit_breaker_recovery_timeout
         }
-    }
+    }))
+
+# Seconds a rendered metrics payload is reused across scrapers; matches the
+# exposition cache so the gzipped copy is only rebuilt when the bytes change
+METRICS_RESPONSE_TTL = METRICS_CACHE_TTL
+
+# Pinned to the 0.0.4 text format: newer prometheus_client sets
+# CONTENT_TYPE_LATEST to version=1.0.0, which older scrapers and proxies reject
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+@async_ttl_cache(ttl=METRICS_RESPONSE_TTL)
+async def _render_metrics():
+    """Render the exposition once per TTL, keeping a gzipped copy alongside"""
+    metrics = await prometheus_metrics.get_metrics_async()
+    return metrics, await asyncio.to_thread(gzip.compress, metrics, 6)
 
 # Prometheus metrics endpoint
 @app.get("/metrics")
-async def get_prometheus_metrics():
+async def get_prometheus_metrics(request: Request):
     """Prometheus metrics endpoint"""
     try:
-        metrics = prometheus_metrics.get_metrics()
+        metrics, metrics_gzip = await _render_metrics()
+        headers = {"Cache-Control": f"max-age={int(METRICS_RESPONSE_TTL)}", "Vary": "Accept-Encoding"}
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            metrics = metrics_gzip
         return Response(
             content=metrics,
-            media_type="text/plain; version=0.0.4; charset=utf-8"
+            media_type=METRICS_CONTENT_TYPE,
+            headers=headers
         )
     except Exception as e:
         logger.error(f"Error generating Prometheus metrics: {e}")
         return Response(
             content="# Error generating metrics\n",
-            media_type="text/plain; version=0.0.4; charset=utf-8",
+            media_type=METRICS_CONTENT_TYPE,
             status_code=500
         )
 
 # Readiness probe endpoint
 @app.get("/ready")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def readiness_probe():
     """Readiness probe - check if service is ready to handle requests"""
     try:
-        readiness_data = await health_checker.readiness_check()
-        return readiness_data
+        return await health_checker.readiness_check()
     except Exception as e:
         logger.error(f"Readiness check failed: {e}")
         return {
@@ -190,11 +277,11 @@ async def readiness_probe():
 
 # Detailed health check endpoint
 @app.get("/health/detailed")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def detailed_health_check():
     """Detailed health check with individual component status"""
     try:
-        health_data = await health_checker.run_all_health_checks()
-        return health_data
+        return await health_checker.run_all_health_checks()
     except Exception as e:
         logger.error(f"Detailed health check failed: {e}")
         return {
@@ -205,16 +292,18 @@ async def detailed_health_check():
 
 # Monitoring health endpoint
 @app.get("/health/monitoring")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def monitoring_health():
     """Detailed monitoring health check"""
     return get_monitoring_health()
 
 # System resources health endpoint
 @app.get("/health/system")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def system_health():
     """System resources health check"""
     try:
-        result = await health_checker.check_system_resources()
+        result = await health_checker._cached("system_resources", health_checker.check_system_resources)
         return {
             "status": result.status.value,
             "message": result.message,
@@ -232,22 +321,15 @@ async def system_health():
 
 # Health check history endpoint
 @app.get("/health/history")
+@cached_json_response(ttl=HEALTH_RESPONSE_TTL)
 async def health_history():
     """Get health check history"""
     try:
-        history = health_checker.health_history[-10:]  # Last 10 checks
+        # Entries are rendered when recorded; take the last 10 checks as-is
+        history = health_checker.health_history
         return {
-            "history": [
-                {
-                    "name": result.name,
-                    "status": result.status.value,
-                    "message": result.message,
-                    "timestamp": result.timestamp,
-                    "duration_ms": round(result.duration * 1000, 2)
-                }
-                for result in history
-            ],
-            "total_checks": len(health_checker.health_history)
+            "history": list(itertools.islice(history, max(0, len(history) - 10), None)),
+            "total_checks": len(history)
         }
     except Exception as e:
         logger.error(f"Health history check failed: {e}")
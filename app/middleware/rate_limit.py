@@ -1,13 +1,13 @@
 from slowapi import Limiter  # type: ignore
 from slowapi.util import get_remote_address  # type: ignore
-from fastapi import Request  # type: ignore
+from slowapi.middleware import SlowAPIMiddleware  # type: ignore
+from starlette.types import Receive, Scope, Send  # type: ignore
 from app.config import get_settings
-
-settings = get_settings()
 from app.utils.redis_client import redis_client
 import limits.aio.storage  # type: ignore
 import logging
 
+settings = get_settings()
 logger = logging.getLogger(__name__)
 
 # Настройка для использования redis-py вместо coredis (для async Redis)
@@ -27,23 +27,37 @@ def get_storage_uri():
         logger.info("Using memory storage for rate limiting")
         return "memory://"
 
-# Limiter с dynamic storage URI
+# Storage is chosen once at import; the limiter cannot switch backends later
+STORAGE_URI = get_storage_uri()
+
 limiter = Limiter(
     key_func=get_remote_address,  # Или custom по user_id
-    storage_uri=get_storage_uri()
+    storage_uri=STORAGE_URI
 )
+logger.info(f"Rate limiter storage initialized to: {STORAGE_URI}")
 
 def get_limiter() -> Limiter:
-    """Get limiter instance with current storage configuration"""
-    # Check if we need to update storage configuration
-    current_storage = get_storage_uri()
-    
-    # Only update if storage URI changed or not set
-    if not hasattr(limiter, '_storage_uri'):
-        limiter._storage_uri = current_storage
-        logger.info(f"Rate limiter storage initialized to: {current_storage}")
-    elif limiter._storage_uri != current_storage:
-        limiter._storage_uri = current_storage
-        logger.info(f"Rate limiter storage updated to: {current_storage}")
-    
-    return limiter
\ No newline at end of file
+    """Get limiter instance"""
+    return limiter
+
+# Probe and scrape endpoints are never rate limited
+RATE_LIMIT_EXEMPT_PATHS = frozenset({
+    "/livez",
+    "/ready",
+    "/metrics",
+    "/health",
+    "/health/detailed",
+    "/health/monitoring",
+    "/health/system",
+    "/health/history",
+    "/health/circuit-breakers",
+})
+
+class ProbeExemptSlowAPIMiddleware(SlowAPIMiddleware):
+    """SlowAPIMiddleware that passes exempt paths straight to the app"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"] in RATE_LIMIT_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
@@ -0,0 +1,27 @@
+from starlette.responses import JSONResponse  # type: ignore
+from starlette.types import ASGIApp, Receive, Scope, Send  # type: ignore
+from app.config import get_settings
+import logging
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class RequestSizeLimitMiddleware:
+    """Rejects requests whose Content-Length exceeds settings.max_request_size_bytes with 413"""
+
+    def __init__(self, app: ASGIApp, max_bytes: int = settings.max_request_size_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    # Limit parsed once at settings load; per request this is an int compare
+                    if value.isdigit() and int(value) > self.max_bytes:
+                        logger.warning(f"Rejected {scope['path']} request of {int(value)} bytes (limit {self.max_bytes})")
+                        response = JSONResponse({"detail": "Request entity too large"}, status_code=413)
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
@@ -1,20 +1,45 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from functools import cached_property
 from typing import List, Dict, Any, Optional
 
+# Shared config: unknown fields are dropped and instances are immutable
+SCHEMA_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=False, arbitrary_types_allowed=False)
+
 class ChatMessage(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     role: str
     content: str
 
 class ChatCompletionRequest(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     model: str
     messages: List[ChatMessage]
     stream: bool = False
 
+    @cached_property
+    def estimated_prompt_tokens(self) -> int:
+        """Rough prompt size: ~4 characters per token plus formatting overhead per message"""
+        total_tokens = 0
+        for message in self.messages:
+            total_tokens += len(message.content) // 4
+        return total_tokens + len(self.messages) * 10
+
+    @cached_property
+    def message_dicts(self) -> List[Dict[str, Any]]:
+        """Messages as plain dicts for the LLM call, dumped once per request"""
+        return ChatMessageList.dump_python(self.messages)
+
 class ChatCompletionResponse(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     choices: List[Dict[str, Any]]
     usage: Dict[str, int]
 
 class ModelInfo(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     id: str
     object: str = "model"
     created: int
@@ -24,10 +49,20 @@ class ModelInfo(BaseModel):
     parent: Optional[str] = None
 
 class ModelsResponse(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     object: str = "list"
     data: List[ModelInfo]
 
 class ErrorResponse(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     detail: str
     code: int
-    error_type: Optional[str] = None
\ No newline at end of file
+    error_type: Optional[str] = None
+
+# Prebuilt adapter for dumping a validated message list in one core call
+ChatMessageList = TypeAdapter(List[ChatMessage])
+
+# Prebuilt adapter for rendering the models list as response_model=List[ModelInfo] would
+ModelInfoList = TypeAdapter(List[ModelInfo])
@@ -1,14 +1,54 @@
+import sys
 import time
+import itertools
 import logging
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
 from typing import Dict, Any, Optional
 from app.monitoring.langfuse_client import langfuse_client
 from app.monitoring.prometheus_metrics import prometheus_metrics
 
 logger = logging.getLogger(__name__)
 
-# Global storage for tracking requests
-request_tracking: Dict[str, Dict[str, Any]] = {}
+# Completed requests are logged 1 in (COMPLETION_LOG_SAMPLE_MASK + 1)
+COMPLETION_LOG_SAMPLE_MASK = 0xFF
+_completion_counter = itertools.count()
+
+# Примерные цены за токен (можно вынести в конфиг); ключи интернированы
+_BASE_PRICES = MappingProxyType({
+    sys.intern(model): price
+    for model, price in (
+        ("gpt-4", 0.00003),
+        ("claude-3", 0.000015),
+        ("gemini-1.5-pro", 0.0000125),
+    )
+})
+DEFAULT_PRICE_PER_TOKEN = 0.00002
+
+# Both sinks are fixed at startup; without either the cost callback has nothing to do
+_MONITORING_ENABLED = langfuse_client.enabled or prometheus_metrics.enabled
+
+@dataclass(slots=True)
+class TrackedRequest:
+    """In-flight LLM request state kept between start and end tracking"""
+    generation_id: Optional[str]
+    start_time: float  # time.monotonic() at start
+    model: str
+    user_id: str
+    stream: bool
+
+# Global storage for tracking requests, oldest first. Bounded so requests
+# whose end callback never fires cannot grow it without limit.
+REQUEST_TRACKING_MAX_SIZE = 100_000
+request_tracking: "OrderedDict[str, TrackedRequest]" = OrderedDict()
+
+def _pop_tracking(request_id: Optional[str]) -> Optional[TrackedRequest]:
+    """Remove and return tracking info for a request, if still present"""
+    if request_id is None:
+        return None
+    return request_tracking.pop(request_id, None)
 
 def track_cost_callback(
     kwargs: Dict[str, Any],
@@ -20,12 +60,17 @@ def track_cost_callback(
     Callback для отслеживания стоимости LLM запросов.
     Интегрирован с Langfuse и Prometheus.
     """
+    if not _MONITORING_ENABLED:
+        # Nothing to record, but the tracking entry still has to go
+        if _pop_tracking(kwargs.get("request_id")) is not None:
+            prometheus_metrics.decrement_active_requests("llm")
+        return
+    
     try:
         # Извлекаем данные из kwargs
         model = kwargs.get("model", "unknown")
-        messages = kwargs.get("messages", [])
         user_id = kwargs.get("user_id", "unknown")
-        request_id = kwargs.get("request_id", str(uuid.uuid4()))
+        request_id = kwargs.get("request_id")
         
         # Вычисляем duration
         duration = end_time - start_time
@@ -34,54 +79,60 @@ def track_cost_callback(
         usage = None
         cost = None
         status = "success"
-        error_message = None
         
-        if hasattr(completion_response, 'usage') and completion_response.usage:
+        response_usage = getattr(completion_response, 'usage', None)
+        if response_usage:
+            try:
+                prompt_tokens, completion_tokens, total_tokens = (
+                    response_usage.prompt_tokens, response_usage.completion_tokens, response_usage.total_tokens
+                )
+            except AttributeError:
+                prompt_tokens = getattr(response_usage, 'prompt_tokens', 0)
+                completion_tokens = getattr(response_usage, 'completion_tokens', 0)
+                total_tokens = getattr(response_usage, 'total_tokens', 0)
             usage = {
-                "prompt_tokens": getattr(completion_response.usage, 'prompt_tokens', 0),
-                "completion_tokens": getattr(completion_response.usage, 'completion_tokens', 0),
-                "total_tokens": getattr(completion_response.usage, 'total_tokens', 0)
-            }
-        
-        # Вычисляем примерную стоимость (можно уточнить)
-        if usage and usage.get("total_tokens"):
-            # Примерные цены (можно вынести в конфиг)
-            base_prices = {
-                "gpt-4": 0.00003,
-                "claude-3": 0.000015,
-                "gemini-1.5-pro": 0.0000125
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": total_tokens
             }
-            price_per_token = base_prices.get(model, 0.00002)
-            cost = usage["total_tokens"] * price_per_token
+            
+            # Вычисляем примерную стоимость (можно уточнить)
+            if total_tokens:
+                cost = total_tokens * _BASE_PRICES.get(model, DEFAULT_PRICE_PER_TOKEN)
         
         # Записываем метрики в Prometheus
-        prometheus_metrics.record_llm_request(
-            model=model,
-            status=status,
-            user_id=user_id,
-            duration=duration,
-            tokens=usage,
-            cost=cost
-        )
+        if prometheus_metrics.enabled:
+            prometheus_metrics.record_llm_request(
+                model=model,
+                status=status,
+                user_id=user_id,
+                duration=duration,
+                tokens=usage,
+                cost=cost
+            )
         
-        # Завершаем отслеживание в Langfuse
-        if request_id in request_tracking:
-            generation_id = request_tracking[request_id].get("generation_id")
-            if generation_id:
+        # Очищаем tracking всегда; Langfuse завершаем, только если он включен
+        tracking_info = _pop_tracking(request_id)
+        if tracking_info is not None:
+            prometheus_metrics.decrement_active_requests("llm")
+            if langfuse_client.enabled and tracking_info.generation_id:
                 langfuse_client.end_generation(
-                    generation_id=generation_id,
+                    generation_id=tracking_info.generation_id,
                     output=str(completion_response) if completion_response else None,
                     usage=usage,
                     cost=cost
                 )
-            
-            # Очищаем tracking
-            del request_tracking[request_id]
         
-        logger.info(
-            f"LLM request completed - Model: {model}, Duration: {duration:.2f}s, "
-            f"Tokens: {usage.get('total_tokens', 0) if usage else 0}, Cost: ${cost:.6f if cost else 0.0}"
-        )
+        if next(_completion_counter) & COMPLETION_LOG_SAMPLE_MASK == 0 and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "llm.done",
+                extra={
+                    "model": model,
+                    "duration": duration,
+                    "total_tokens": usage.get("total_tokens", 0) if usage else 0,
+                    "cost": cost or 0.0,
+                }
+            )
         
     except Exception as e:
         logger.error(f"Error in track_cost_callback: {e}")
@@ -96,20 +147,18 @@ def track_cost_callback(
                 model=model,
                 status="error",
                 user_id=user_id,
-                duration=duration,
-                error_message=str(e)
+                duration=duration
             )
             
             # Завершаем с ошибкой в Langfuse
-            request_id = kwargs.get("request_id")
-            if request_id and request_id in request_tracking:
-                generation_id = request_tracking[request_id].get("generation_id")
-                if generation_id:
+            tracking_info = _pop_tracking(kwargs.get("request_id"))
+            if tracking_info is not None:
+                prometheus_metrics.decrement_active_requests("llm")
+                if langfuse_client.enabled and tracking_info.generation_id:
                     langfuse_client.end_generation(
-                        generation_id=generation_id,
+                        generation_id=tracking_info.generation_id,
                         error=str(e)
                     )
-                del request_tracking[request_id]
                 
         except Exception as metric_error:
             logger.error(f"Error recording error metrics: {metric_error}")
@@ -125,8 +174,10 @@ def start_llm_tracking(
     Возвращает request_id для последующего использования.
     """
     try:
-        request_id = str(uuid.uuid4())
-        start_time = time.time()
+        request_id = uuid.uuid4().hex
+        start_time = time.monotonic()
+        # Model names are few and long-lived in tracking entries; share one copy
+        model = sys.intern(model)
         
         # Начинаем отслеживание в Langfuse
         generation_id = langfuse_client.start_generation(
@@ -138,13 +189,9 @@ def start_llm_tracking(
         )
         
         # Сохраняем информацию для tracking
-        request_tracking[request_id] = {
-            "generation_id": generation_id,
-            "start_time": start_time,
-            "model": model,
-            "user_id": user_id,
-            "stream": stream
-        }
+        request_tracking[request_id] = TrackedRequest(generation_id, start_time, model, user_id, stream)
+        if len(request_tracking) > REQUEST_TRACKING_MAX_SIZE:
+            request_tracking.popitem(last=False)
         
         # Увеличиваем счетчик активных запросов
         prometheus_metrics.increment_active_requests("llm")
@@ -155,7 +202,7 @@ def start_llm_tracking(
         
     except Exception as e:
         logger.error(f"Error starting LLM tracking: {e}")
-        return str(uuid.uuid4())  # Fallback ID
+        return uuid.uuid4().hex  # Fallback ID
 
 def end_llm_tracking(
     request_id: str,
@@ -168,30 +215,25 @@ def end_llm_tracking(
     Завершает отслеживание LLM запроса.
     """
     try:
-        if request_id not in request_tracking:
+        tracking_info = _pop_tracking(request_id)
+        if tracking_info is None:
             logger.warning(f"Request ID {request_id} not found in tracking")
             return
         
-        tracking_info = request_tracking[request_id]
-        end_time = time.time()
-        duration = end_time - tracking_info["start_time"]
+        duration = time.monotonic() - tracking_info.start_time
         
         # Уменьшаем счетчик активных запросов
         prometheus_metrics.decrement_active_requests("llm")
         
         # Завершаем в Langfuse
-        generation_id = tracking_info.get("generation_id")
-        if generation_id:
+        if tracking_info.generation_id:
             langfuse_client.end_generation(
-                generation_id=generation_id,
+                generation_id=tracking_info.generation_id,
                 usage=usage,
                 cost=cost,
                 error=error_message if not success else None
             )
         
-        # Очищаем tracking
-        del request_tracking[request_id]
-        
         logger.info(f"Ended LLM tracking - Request ID: {request_id}, Duration: {duration:.2f}s")
         
     except Exception as e:
@@ -254,15 +296,6 @@ def update_circuit_breaker_state(model: str, state: str):
     except Exception as e:
         logger.error(f"Error updating circuit breaker state: {e}")
 
-def update_user_balance(user_id: str, balance: float):
-    """
-    Обновляет баланс пользователя в метриках.
-    """
-    try:
-        prometheus_metrics.update_user_balance(user_id, balance)
-    except Exception as e:
-        logger.error(f"Error updating user balance: {e}")
-
 def get_monitoring_health() -> Dict[str, Any]:
     """
     Возвращает статус здоровья всех monitoring компонентов.
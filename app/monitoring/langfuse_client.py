@@ -1,35 +1,19 @@
 import os
-import time
 import logging
 from typing import Dict, Any, Optional, List
-from dataclasses import dataclass
 from datetime import datetime
-import asyncio
+import httpx
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class LLMRequest:
-    """Структура для LLM запроса"""
-    model: str
-    messages: List[Dict[str, str]]
-    user_id: str
-    request_id: str
-    start_time: float
-    stream: bool = False
+# Background batching for the SDK's ingestion queue: events are sent in
+# batches of up to LANGFUSE_FLUSH_AT or every LANGFUSE_FLUSH_INTERVAL seconds
+LANGFUSE_FLUSH_AT = 100
+LANGFUSE_FLUSH_INTERVAL = 1.0
 
-@dataclass
-class LLMResponse:
-    """Структура для LLM ответа"""
-    request_id: str
-    model: str
-    completion_tokens: Optional[int] = None
-    prompt_tokens: Optional[int] = None
-    total_tokens: Optional[int] = None
-    cost: Optional[float] = None
-    end_time: Optional[float] = None
-    success: bool = True
-    error_message: Optional[str] = None
+# Keep-alive pool shared by the SDK's exporter threads
+LANGFUSE_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+LANGFUSE_HTTP_TIMEOUT = 5.0
 
 class LangfuseClient:
     """Клиент для интеграции с Langfuse"""
@@ -37,13 +21,22 @@ class LangfuseClient:
     def __init__(self, langfuse_secret_key: Optional[str] = None):
         self.langfuse_secret_key = langfuse_secret_key or os.getenv("LANGFUSE_SECRET_KEY")
         self.enabled = bool(self.langfuse_secret_key)
+        self.http_client: Optional[httpx.Client] = None
         
         if self.enabled:
             try:
                 from langfuse import Langfuse
+                self.http_client = httpx.Client(
+                    http2=True,
+                    limits=LANGFUSE_HTTP_LIMITS,
+                    timeout=LANGFUSE_HTTP_TIMEOUT
+                )
                 self.client = Langfuse(
                     secret_key=self.langfuse_secret_key,
-                    host=os.getenv("LANGFUSE_HOST", "https://cloud.langfuse.com")
+                    host=os.getenv("LANGFUSE_HOST", "https://cloud.langfuse.com"),
+                    httpx_client=self.http_client,
+                    flush_at=LANGFUSE_FLUSH_AT,
+                    flush_interval=LANGFUSE_FLUSH_INTERVAL
                 )
                 logger.info("Langfuse client initialized successfully")
             except ImportError:
@@ -196,6 +189,23 @@ class LangfuseClient:
         except Exception as e:
             logger.error(f"Failed to end Langfuse span: {e}")
     
+    def flush(self):
+        """Отправляет накопленные события (блокирует до опустошения очереди)"""
+        if not self.enabled:
+            return
+        
+        try:
+            self.client.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush Langfuse events: {e}")
+    
+    def close(self):
+        """Отправляет накопленные события и закрывает HTTP клиент"""
+        self.flush()
+        if self.http_client is not None:
+            self.http_client.close()
+            self.http_client = None
+    
     def health_check(self) -> Dict[str, Any]:
         """Проверка здоровья Langfuse клиента"""
         return {
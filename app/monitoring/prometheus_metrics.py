@@ -1,6 +1,10 @@
 import time
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+import threading
+from collections import Counter as TallyCounter
+from dataclasses import dataclass, field
+from typing import Dict, Any, Iterator, List, Optional
 from prometheus_client import (
     Counter, 
     Histogram, 
@@ -9,39 +13,107 @@ from prometheus_client import (
     generate_latest,
     CONTENT_TYPE_LATEST
 )
-from prometheus_client.core import CollectorRegistry
+from prometheus_client.core import CollectorRegistry, CounterMetricFamily
+from app.config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on memoized label children across all metrics
+LABEL_CHILD_CACHE_SIZE = 4096
+
+# Seconds a rendered exposition is reused (well under the usual 15 s scrape interval)
+METRICS_CACHE_TTL = 5.0
+
+@dataclass(slots=True)
+class _UsageShard:
+    """LLM usage totals written by a single thread"""
+    requests: TallyCounter = field(default_factory=TallyCounter)  # (model, status)
+    tokens: TallyCounter = field(default_factory=TallyCounter)  # (model, token_type)
+    cost: TallyCounter = field(default_factory=TallyCounter)  # (model,)
+
+class LLMUsageCollector:
+    """Коллектор LLM счетчиков: запись в поток-локальные шарды без блокировок, суммирование при scrape"""
+    
+    def __init__(self):
+        self._local = threading.local()
+        # Shards are kept after their thread exits so counters never go backwards
+        self._shards: List[_UsageShard] = []
+        self._shards_lock = threading.Lock()
+    
+    def _shard(self) -> _UsageShard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _UsageShard()
+            self._local.shard = shard
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+    
+    def record(
+        self,
+        model: str,
+        status: str,
+        tokens: Optional[Dict[str, int]] = None,
+        cost: Optional[float] = None
+    ):
+        shard = self._shard()
+        shard.requests[(model, status)] += 1
+        if tokens:
+            for token_type, count in tokens.items():
+                if count > 0:
+                    shard.tokens[(model, token_type)] += count
+        if cost and cost > 0:
+            shard.cost[(model,)] += cost
+    
+    def _families(self) -> List[CounterMetricFamily]:
+        return [
+            CounterMetricFamily('llm_requests_total', 'Total number of LLM requests', labels=['model', 'status']),
+            CounterMetricFamily('llm_tokens_total', 'Total number of tokens processed', labels=['model', 'token_type']),
+            CounterMetricFamily('llm_cost_total', 'Total cost of LLM requests', labels=['model']),
+        ]
+    
+    def describe(self) -> Iterator[CounterMetricFamily]:
+        return iter(self._families())
+    
+    def collect(self) -> Iterator[CounterMetricFamily]:
+        requests, tokens, cost = TallyCounter(), TallyCounter(), TallyCounter()
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # dict copies are atomic, so a writer mid-update cannot break iteration
+            requests.update(shard.requests.copy())
+            tokens.update(shard.tokens.copy())
+            cost.update(shard.cost.copy())
+        families = self._families()
+        for family, totals in zip(families, (requests, tokens, cost)):
+            for labels, value in totals.items():
+                family.add_metric(labels, value)
+        return iter(families)
+
 class PrometheusMetrics:
     """Класс для управления Prometheus метриками"""
     
     def __init__(self):
+        self.enabled = get_settings().monitoring.prometheus_enabled
+        
         # Создаем отдельный registry для изоляции метрик
         self.registry = CollectorRegistry()
+        # (metric, label values) -> bound child, see _child()
+        self._children: Dict[tuple, Any] = {}
+        # Last rendered exposition, see get_metrics()
+        self._cached_bytes = b""
+        self._cached_at = float("-inf")
+        self._gen_lock = threading.Lock()
+        self._inflight: Optional["asyncio.Future[bytes]"] = None
         
-        # Counters
-        self.llm_requests_total = Counter(
-            'llm_requests_total',
-            'Total number of LLM requests',
-            ['model', 'status', 'user_id'],
-            registry=self.registry
-        )
+        # Metrics carry no user_id label: per-user accounting lives in the billing
+        # tables, and a per-user series would grow with the user base
         
-        self.llm_tokens_total = Counter(
-            'llm_tokens_total',
-            'Total number of tokens processed',
-            ['model', 'token_type', 'user_id'],
-            registry=self.registry
-        )
-        
-        self.llm_cost_total = Counter(
-            'llm_cost_total',
-            'Total cost of LLM requests',
-            ['model', 'user_id'],
-            registry=self.registry
-        )
+        # LLM request, token and cost counters (llm_*_total), summed at scrape time
+        self.llm_usage = LLMUsageCollector()
+        self.registry.register(self.llm_usage)
         
+        # Counters
         self.api_requests_total = Counter(
             'api_requests_total',
             'Total number of API requests',
@@ -52,7 +124,7 @@ class PrometheusMetrics:
         self.rate_limit_exceeded_total = Counter(
             'rate_limit_exceeded_total',
             'Total number of rate limit violations',
-            ['endpoint', 'user_id'],
+            ['endpoint'],
             registry=self.registry
         )
         
@@ -95,13 +167,6 @@ class PrometheusMetrics:
             registry=self.registry
         )
         
-        self.user_balance = Gauge(
-            'user_balance',
-            'Current user balance',
-            ['user_id'],
-            registry=self.registry
-        )
-        
         # Summaries
         self.llm_response_size_bytes = Summary(
             'llm_response_size_bytes',
@@ -110,6 +175,17 @@ class PrometheusMetrics:
             registry=self.registry
         )
     
+    def _child(self, metric, *label_values: str):
+        """Bound child for the label values, resolved via labels() once per combination"""
+        key = (metric, label_values)
+        child = self._children.get(key)
+        if child is None:
+            child = metric.labels(*label_values)
+            # Stop memoizing past the cap so an unexpected label explosion cannot grow it forever
+            if len(self._children) < LABEL_CHILD_CACHE_SIZE:
+                self._children[key] = child
+        return child
+    
     def record_llm_request(
         self,
         model: str,
@@ -122,39 +198,15 @@ class PrometheusMetrics:
     ):
         """Записывает метрики для LLM запроса"""
         try:
-            # Increment request counter
-            self.llm_requests_total.labels(
-                model=model,
-                status=status,
-                user_id=user_id
-            ).inc()
+            # Request, token and cost counters
+            self.llm_usage.record(model, status, tokens, cost)
             
             # Record duration
-            self.llm_request_duration_seconds.labels(
-                model=model,
-                status=status
-            ).observe(duration)
-            
-            # Record tokens if available
-            if tokens:
-                for token_type, count in tokens.items():
-                    if count > 0:
-                        self.llm_tokens_total.labels(
-                            model=model,
-                            token_type=token_type,
-                            user_id=user_id
-                        ).inc(count)
-            
-            # Record cost if available
-            if cost and cost > 0:
-                self.llm_cost_total.labels(
-                    model=model,
-                    user_id=user_id
-                ).inc(cost)
+            self._child(self.llm_request_duration_seconds, model, status).observe(duration)
             
             # Record response size if available
             if response_size:
-                self.llm_response_size_bytes.labels(model=model).observe(response_size)
+                self._child(self.llm_response_size_bytes, model).observe(response_size)
                 
         except Exception as e:
             logger.error(f"Failed to record LLM metrics: {e}")
@@ -169,17 +221,10 @@ class PrometheusMetrics:
         """Записывает метрики для API запроса"""
         try:
             # Increment request counter
-            self.api_requests_total.labels(
-                endpoint=endpoint,
-                method=method,
-                status_code=str(status_code)
-            ).inc()
+            self._child(self.api_requests_total, endpoint, method, str(status_code)).inc()
             
             # Record duration
-            self.api_request_duration_seconds.labels(
-                endpoint=endpoint,
-                method=method
-            ).observe(duration)
+            self._child(self.api_request_duration_seconds, endpoint, method).observe(duration)
             
         except Exception as e:
             logger.error(f"Failed to record API metrics: {e}")
@@ -187,17 +232,14 @@ class PrometheusMetrics:
     def record_rate_limit_exceeded(self, endpoint: str, user_id: str):
         """Записывает метрику превышения rate limit"""
         try:
-            self.rate_limit_exceeded_total.labels(
-                endpoint=endpoint,
-                user_id=user_id
-            ).inc()
+            self._child(self.rate_limit_exceeded_total, endpoint).inc()
         except Exception as e:
             logger.error(f"Failed to record rate limit metrics: {e}")
     
     def record_circuit_breaker_open(self, model: str):
         """Записывает метрику открытия circuit breaker"""
         try:
-            self.circuit_breaker_opens_total.labels(model=model).inc()
+            self._child(self.circuit_breaker_opens_total, model).inc()
         except Exception as e:
             logger.error(f"Failed to record circuit breaker metrics: {e}")
     
@@ -210,47 +252,62 @@ class PrometheusMetrics:
                 "open": 2
             }.get(state, 0)
             
-            self.circuit_breaker_state.labels(model=model).set(state_value)
+            self._child(self.circuit_breaker_state, model).set(state_value)
         except Exception as e:
             logger.error(f"Failed to update circuit breaker state: {e}")
     
-    def update_user_balance(self, user_id: str, balance: float):
-        """Обновляет баланс пользователя"""
-        try:
-            self.user_balance.labels(user_id=user_id).set(balance)
-        except Exception as e:
-            logger.error(f"Failed to update user balance: {e}")
-    
     def increment_active_requests(self, endpoint: str):
         """Увеличивает счетчик активных запросов"""
         try:
-            self.active_requests.labels(endpoint=endpoint).inc()
+            self._child(self.active_requests, endpoint).inc()
         except Exception as e:
             logger.error(f"Failed to increment active requests: {e}")
     
     def decrement_active_requests(self, endpoint: str):
         """Уменьшает счетчик активных запросов"""
         try:
-            self.active_requests.labels(endpoint=endpoint).dec()
+            self._child(self.active_requests, endpoint).dec()
         except Exception as e:
             logger.error(f"Failed to decrement active requests: {e}")
     
     def get_metrics(self) -> bytes:
-        """Возвращает метрики в формате Prometheus"""
-        try:
-            return generate_latest(self.registry)
-        except Exception as e:
-            logger.error(f"Failed to generate metrics: {e}")
-            return b""
+        """Возвращает метрики в формате Prometheus (кэшируется на METRICS_CACHE_TTL секунд)"""
+        if time.monotonic() - self._cached_at < METRICS_CACHE_TTL:
+            return self._cached_bytes
+        
+        with self._gen_lock:
+            # Another thread may have regenerated while we waited
+            if time.monotonic() - self._cached_at < METRICS_CACHE_TTL:
+                return self._cached_bytes
+            try:
+                self._cached_bytes = generate_latest(self.registry)
+                self._cached_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Failed to generate metrics: {e}")
+                return b""
+            return self._cached_bytes
+    
+    async def get_metrics_async(self) -> bytes:
+        """Async get_metrics: renders off the event loop, concurrent callers share one render"""
+        if time.monotonic() - self._cached_at < METRICS_CACHE_TTL:
+            return self._cached_bytes
+        
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(asyncio.to_thread(self.get_metrics))
+            self._inflight.add_done_callback(self._clear_inflight)
+        return await asyncio.shield(self._inflight)
+    
+    def _clear_inflight(self, future: "asyncio.Future[bytes]") -> None:
+        if self._inflight is future:
+            self._inflight = None
     
     def health_check(self) -> Dict[str, Any]:
         """Проверка здоровья метрик"""
         try:
-            # Проверяем, что можем генерировать метрики
-            metrics = self.get_metrics()
+            # Size of the last scrape's exposition; never renders on the caller's (event loop) thread
             return {
                 "status": "healthy",
-                "metrics_size": len(metrics),
+                "metrics_size": len(self._cached_bytes),
                 "registry_size": len(self.registry._collector_to_names)
             }
         except Exception as e:
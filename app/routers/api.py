@@ -1,15 +1,17 @@
 from fastapi import APIRouter, HTTPException, Depends, Request
-from fastapi.responses import StreamingResponse
-from typing import Dict, Any, Optional, List
-import json
+from fastapi.responses import Response, StreamingResponse
+from typing import Dict, Any, Optional, List, Tuple
+import orjson
 import logging
 import time
 import asyncio
+from datetime import datetime
+from uuid import UUID
 from functools import lru_cache
-from app.services.billing_service import estimate_cost, update_balance, get_balance
+from app.services.billing_service import estimate_cost, prompt_cost, completion_cost, update_balance, charge_balance, get_balance
 from app.services.litellm_service import call_llm, get_supported_models
 from app.dependencies import get_current_user_async
-from app.models.schemas import ChatCompletionRequest, ChatCompletionResponse, ModelInfo
+from app.models.schemas import ChatCompletionRequest, ChatCompletionResponse, ModelInfo, ModelInfoList
 from app.utils.exceptions import InsufficientFundsError, LLMServiceError
 from app.utils.redis_client import redis_client
 from app.config import get_settings
@@ -18,67 +20,115 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 settings = get_settings()
 
-# Memory cache fallback for models
-_models_cache = None
-_models_cache_timestamp = 0
+# Memory cache for models: (monotonic time stored, rendered JSON body)
+_models_cache: Optional[Tuple[float, bytes]] = None
 MODELS_CACHE_TTL = 300  # 5 minutes
+MODELS_CACHE_KEY = "models:list"
+# Single-flight guard so concurrent misses rebuild the list once
+_models_lock = asyncio.Lock()
 
-def get_models_from_cache():
-    """Get models from memory cache with TTL"""
-    global _models_cache, _models_cache_timestamp
-    current_time = time.time()
-    
-    if (_models_cache is not None and 
-        current_time - _models_cache_timestamp < MODELS_CACHE_TTL):
-        return _models_cache
+def get_models_from_cache() -> Optional[bytes]:
+    """Get the rendered models body from memory cache with TTL"""
+    cached = _models_cache
+    if cached is not None and time.monotonic() - cached[0] < MODELS_CACHE_TTL:
+        return cached[1]
     
     return None
 
-def set_models_cache(models):
-    """Set models in memory cache"""
-    global _models_cache, _models_cache_timestamp
-    _models_cache = models
-    _models_cache_timestamp = time.time()
+def set_models_cache(body: bytes):
+    """Set the rendered models body in memory cache"""
+    global _models_cache
+    _models_cache = (time.monotonic(), body)
 
-async def get_cached_models():
-    """Get models with Redis caching and memory fallback"""
-    try:
-        # Try Redis first
-        if settings.rate_limit_storage == "redis" and redis_client.is_connected():
-            cached_models = await redis_client.get("models:list")
-            if cached_models:
-                logger.debug("Models retrieved from Redis cache")
-                return json.loads(cached_models)
-    except Exception as e:
-        logger.warning(f"Redis cache failed, falling back to memory: {e}")
-    
-    # Fallback to memory cache
+async def get_cached_models() -> Optional[bytes]:
+    """Get the rendered models body from memory cache, then Redis"""
+    # Memory first: a hit needs no Redis round-trip
     memory_cached = get_models_from_cache()
     if memory_cached:
         logger.debug("Models retrieved from memory cache")
         return memory_cached
     
+    try:
+        if settings.rate_limit_storage == "redis":
+            cached_models = await asyncio.to_thread(redis_client.get_client().get, MODELS_CACHE_KEY)
+            if cached_models:
+                logger.debug("Models retrieved from Redis cache")
+                # Stored already rendered; the client decodes responses to str
+                body = cached_models.encode() if isinstance(cached_models, str) else cached_models
+                set_models_cache(body)
+                return body
+    except Exception as e:
+        logger.warning(f"Redis cache failed, falling back to fresh models: {e}")
+    
     # No cache available, fetch fresh data
     logger.debug("No cache available, fetching fresh models")
     return None
 
-async def set_cached_models(models):
-    """Set models in cache (Redis + memory)"""
+async def set_cached_models(models) -> bytes:
+    """Render models once and cache the body (Redis + memory)"""
+    body = ModelInfoList.dump_json(ModelInfoList.validate_python(models))
+    
+    # Always set in memory
+    set_models_cache(body)
+    logger.debug("Models cached in memory")
+    
     try:
-        # Set in Redis
-        if settings.rate_limit_storage == "redis" and redis_client.is_connected():
-            await redis_client.setex(
-                "models:list", 
-                MODELS_CACHE_TTL, 
-                json.dumps(models)
+        # Share with other workers through Redis
+        if settings.rate_limit_storage == "redis":
+            await asyncio.to_thread(
+                redis_client.get_client().setex,
+                MODELS_CACHE_KEY,
+                MODELS_CACHE_TTL,
+                body
             )
             logger.debug("Models cached in Redis")
     except Exception as e:
         logger.warning(f"Failed to cache models in Redis: {e}")
     
-    # Always set in memory as fallback
-    set_models_cache(models)
-    logger.debug("Models cached in memory")
+    return body
+
+# Server-sent event framing for streamed chunks
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+def _stream_chunk_dict(chunk, model: str) -> Dict[str, Any]:
+    """Convert a LiteLLM stream chunk to a JSON-serializable dict"""
+    try:
+        chunk_id, chunk_object, created, chunk_model = chunk.id, chunk.object, chunk.created, chunk.model
+    except AttributeError:
+        chunk_id = getattr(chunk, 'id', None)
+        chunk_object = getattr(chunk, 'object', 'chat.completion.chunk')
+        created = getattr(chunk, 'created', int(time.time()))
+        chunk_model = getattr(chunk, 'model', model)
+    
+    choices = []
+    for choice in getattr(chunk, 'choices', ()):
+        delta = choice.delta
+        try:
+            role, content, function_call, tool_calls = delta.role, delta.content, delta.function_call, delta.tool_calls
+        except AttributeError:
+            role = getattr(delta, 'role', 'assistant')
+            content = getattr(delta, 'content', '')
+            function_call = getattr(delta, 'function_call', None)
+            tool_calls = getattr(delta, 'tool_calls', None)
+        choices.append({
+            "index": choice.index,
+            "delta": {
+                "role": role,
+                "content": content,
+                "function_call": function_call,
+                "tool_calls": tool_calls
+            },
+            "finish_reason": getattr(choice, 'finish_reason', None)
+        })
+    
+    return {
+        "id": chunk_id,
+        "object": chunk_object,
+        "created": created,
+        "model": chunk_model,
+        "choices": choices
+    }
 
 @router.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 async def chat_completions(
@@ -103,7 +153,7 @@ async def chat_completions(
         # Вызываем LLM сервис
         llm_response = await call_llm(
             model=request.model,
-            messages=[{"role": msg.role, "content": msg.content} for msg in request.messages],
+            messages=request.message_dicts,
             stream=False,
             user_id=user_id
         )
@@ -198,40 +248,30 @@ async def chat_completions_stream(
         
         # Создаем потоковый ответ
         async def generate_stream():
-            total_cost = 0.0
+            # Prompt is charged once; generated text is counted as it streams
+            total_cost = prompt_cost(request)
+            completion_chars = 0
+            response = None
             try:
                 response = await call_llm(
                     model=request.model,
-                    messages=[{"role": msg.role, "content": msg.content} for msg in request.messages],
+                    messages=request.message_dicts,
                     stream=True,
                     user_id=user_id
                 )
                 async for chunk in response:
-                    total_cost += estimate_cost(request, chunk)
-                    # Convert LiteLLM object to dict for JSON serialization
-                    chunk_dict = {
-                        "id": getattr(chunk, 'id', None),
-                        "object": getattr(chunk, 'object', 'chat.completion.chunk'),
-                        "created": getattr(chunk, 'created', int(time.time())),
-                        "model": getattr(chunk, 'model', request.model),
-                        "choices": [
-                            {
-                                "index": choice.index,
-                                "delta": {
-                                    "role": getattr(choice.delta, 'role', 'assistant'),
-                                    "content": getattr(choice.delta, 'content', ''),
-                                    "function_call": getattr(choice.delta, 'function_call', None),
-                                    "tool_calls": getattr(choice.delta, 'tool_calls', None)
-                                },
-                                "finish_reason": getattr(choice, 'finish_reason', None)
-                            }
-                            for choice in chunk.choices
-                        ] if hasattr(chunk, 'choices') else []
-                    }
-                    yield f"data: {json.dumps(chunk_dict)}\n\n"
+                    chunk_dict = _stream_chunk_dict(chunk, request.model)
+                    for choice in chunk_dict["choices"]:
+                        content = choice["delta"]["content"]
+                        if content:
+                            completion_chars += len(content)
+                    yield SSE_PREFIX + orjson.dumps(chunk_dict) + SSE_SUFFIX
+                
+                # Rough token estimation: ~4 characters per token
+                total_cost += completion_cost(request.model, completion_chars // 4)
                 
                 # Обновляем баланс после завершения стрима
-                await update_balance(
+                await charge_balance(
                     user_id, 
                     -total_cost, 
                     f"Streaming chat completion with {request.model}"
@@ -239,7 +279,11 @@ async def chat_completions_stream(
                 
             except Exception as e:
                 logger.error(f"Error in streaming response: {e}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield SSE_PREFIX + orjson.dumps({"error": str(e)}) + SSE_SUFFIX
+            finally:
+                # Frees the provider concurrency slot even when the client disconnects
+                if response is not None:
+                    await response.aclose()
         
         return StreamingResponse(
             generate_stream(),
@@ -258,8 +302,8 @@ async def chat_completions_stream(
         logger.warning(f"Returning fallback streaming response due to error: {e}")
         
         async def fallback_stream():
-            yield f"data: {json.dumps({'error': 'Service temporarily unavailable. Please try again later.'})}\n\n"
-            yield "data: [DONE]\n\n"
+            yield SSE_PREFIX + orjson.dumps({"error": "Service temporarily unavailable. Please try again later."}) + SSE_SUFFIX
+            yield SSE_PREFIX + b"[DONE]" + SSE_SUFFIX
         
         return StreamingResponse(
             fallback_stream(),
@@ -273,18 +317,18 @@ async def list_models():
     Возвращает список доступных моделей с кэшированием
     """
     try:
-        # Try to get from cache first
-        cached_models = await get_cached_models()
-        if cached_models:
-            return cached_models
-        
-        # Fetch fresh models if not in cache
-        models = get_supported_models()
+        # Try to get from cache first; the cache holds the finished JSON body
+        body = await get_cached_models()
         
-        # Cache the models for future requests
-        await set_cached_models(models)
+        if not body:
+            async with _models_lock:
+                # Another request may have rebuilt the list while we waited
+                body = get_models_from_cache()
+                if not body:
+                    # Fetch fresh models and cache the rendered body for future requests
+                    body = await set_cached_models(get_supported_models())
         
-        return models
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         logger.error(f"Error getting models: {e}")
         raise HTTPException(status_code=500, detail="Failed to get models")
@@ -309,19 +353,25 @@ async def get_user_balance(user_id: str = Depends(get_current_user_async)):
 async def get_user_transactions(
     user_id: str = Depends(get_current_user_async),
     limit: int = 10,
-    offset: int = 0
+    offset: int = 0,
+    before: Optional[datetime] = None,
+    before_id: Optional[UUID] = None
 ):
     """
     Получить историю транзакций пользователя
     """
     try:
         from app.services.billing_service import get_transaction_history
-        transactions = await get_transaction_history(user_id, limit, offset)
+        transactions = await get_transaction_history(user_id, limit, offset, before, before_id)
+        last = transactions[-1] if transactions and len(transactions) == limit else None
         return {
             "user_id": user_id,
             "transactions": transactions,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            # Cursor for the next page: pass both back as ?before=&before_id=
+            "next_before": last["timestamp"] if last else None,
+            "next_before_id": last["id"] if last else None
         }
     except Exception as e:
         logger.error(f"Error getting transactions for user {user_id}: {e}")
@@ -332,5 +382,7 @@ async def get_user_transactions(
             "transactions": [],
             "limit": limit,
             "offset": offset,
+            "next_before": None,
+            "next_before_id": None,
             "warning": "Using empty transactions due to database issues"
         }
\ No newline at end of file
@@ -1,11 +1,14 @@
-from app.db.async_postgres_client import get_async_postgres_client, AsyncPostgresClient
+from app.db.async_postgres_client import get_async_postgres_client, AsyncPostgresClient, TRANSIENT_DB_ERRORS, is_transient_db_error
 from app.utils.exceptions import InsufficientFundsError
 from app.config import get_settings
 from app.utils.retry import retry_with_exponential_backoff
 
 settings = get_settings()
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+from datetime import datetime
+from uuid import UUID
+from typing import Optional, Dict, Any, List, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +18,7 @@ class BillingTransactionError(Exception):
 
 
 # Async billing operations using PostgreSQL
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
 async def get_balance(user_id: str) -> float:
     """Get user balance using async PostgreSQL client with retry logic"""
     try:
@@ -24,14 +27,15 @@ async def get_balance(user_id: str) -> float:
         if db._pool is None:
             logger.warning(f"Database not available, using default balance for user {user_id}")
             return 100.0
-        return await db.get_balance(user_id)
+        # Include charges that are queued but not yet written
+        return await db.get_balance(user_id) + balance_batcher.pending.get(user_id, 0.0)
     except Exception as e:
         logger.error(f"Error getting balance for user {user_id}: {e}")
         # Return default balance for graceful degradation
         logger.warning(f"Using default balance for user {user_id} due to database error")
         return 100.0  # Default balance for development
 
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
 async def update_balance(user_id: str, amount: float, description: str) -> Dict[str, Any]:
     """Update user balance with transaction record using async PostgreSQL with retry logic"""
     try:
@@ -63,19 +67,143 @@ async def update_balance(user_id: str, amount: float, description: str) -> Dict[
             "warning": "Mock transaction due to database issues"
         }
 
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
-async def get_transaction_history(user_id: str, limit: int = 10, offset: int = 0) -> list:
+# Deferred charges are written together for up to this long or this many events
+BALANCE_FLUSH_INTERVAL = 0.2
+BALANCE_FLUSH_MAX_EVENTS = 100
+# Pause before retrying a batch that hit a connection-level error, and how
+# many times it is retried before its charges are logged and dropped
+BALANCE_RETRY_DELAY = 1.0
+BALANCE_MAX_RETRIES = 5
+
+class BalanceUpdateBatcher:
+    """Очередь отложенных изменений баланса: одна транзакция БД на батч, отдельная запись на каждое списание"""
+    
+    def __init__(self):
+        self._queue: Optional["asyncio.Queue[Optional[Tuple[str, float, str]]]"] = None
+        self._task: Optional[asyncio.Task] = None
+        # Queued but unwritten amounts per user, added to this worker's balance reads
+        self.pending: Dict[str, float] = {}
+    
+    def start(self):
+        """Start the background writer (called at app startup)"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Write everything still queued, then stop the background writer"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+    
+    def submit(self, user_id: str, amount: float, description: str) -> bool:
+        """Queue a balance change; False when the writer is not running"""
+        if self._task is None:
+            return False
+        self.pending[user_id] = self.pending.get(user_id, 0.0) + amount
+        self._queue.put_nowait((user_id, amount, description))
+        return True
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + BALANCE_FLUSH_INTERVAL
+            while len(batch) < BALANCE_FLUSH_MAX_EVENTS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            # Nothing is committed when a flush asks for a retry, so the same batch is written again
+            attempt = 0
+            while not await self._flush(batch, retry_allowed=not stopping and attempt < BALANCE_MAX_RETRIES):
+                attempt += 1
+                await asyncio.sleep(BALANCE_RETRY_DELAY)
+    
+    async def _flush(self, batch: List[Tuple[str, float, str]], retry_allowed: bool = True) -> bool:
+        """Write a batch in one transaction; False when it should be retried"""
+        try:
+            db = await get_async_postgres_client()
+            if db._pool is None:
+                logger.warning(f"Database not available, skipping {len(batch)} deferred balance updates")
+                self._settle(batch)
+                return True
+            results = await db.apply_balance_updates(batch)
+        except Exception as e:
+            if retry_allowed and is_transient_db_error(e):
+                logger.error(f"Deferred balance batch of {len(batch)} updates failed, retrying: {e}")
+                return False
+            for item in batch:
+                self._log_unwritten(item, e)
+            self._settle(batch)
+            return True
+        for item, result in zip(batch, results):
+            if result["error"] is not None:
+                # Deterministic failure of this item only; the rest of the batch was committed
+                self._log_unwritten(item, result["error"])
+            elif result["shortfall"] > 0:
+                logger.warning(
+                    f"Balance of user {result['user_id']} could not cover a deferred charge of "
+                    f"{-result['amount']}; unpaid {result['shortfall']}"
+                )
+        self._settle(batch)
+        return True
+    
+    @staticmethod
+    def _log_unwritten(item: Tuple[str, float, str], error: BaseException):
+        """Leave a dropped charge in the log so it can be replayed"""
+        user_id, amount, description = item
+        logger.error(f"Unwritten balance update for user {user_id}: amount={amount} description={description!r} error={error}")
+    
+    def _settle(self, batch: List[Tuple[str, float, str]]):
+        """Drop written (or given up) amounts from the pending totals"""
+        for user_id, amount, _ in batch:
+            remaining = self.pending.get(user_id, 0.0) - amount
+            if abs(remaining) < 1e-12:
+                self.pending.pop(user_id, None)
+            else:
+                self.pending[user_id] = remaining
+
+# Global batcher instance
+balance_batcher = BalanceUpdateBatcher()
+
+async def charge_balance(user_id: str, amount: float, description: str) -> None:
+    """Apply a streamed completion's charge off the request path, writing directly if the batcher is not running"""
+    if not balance_batcher.submit(user_id, amount, description):
+        await update_balance(user_id, amount, description)
+
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
+async def get_transaction_history(
+    user_id: str,
+    limit: int = 10,
+    offset: int = 0,
+    before: Optional[datetime] = None,
+    before_id: Optional[UUID] = None
+) -> list:
     """Get transaction history for a user using async PostgreSQL with retry logic"""
     try:
         db = await get_async_postgres_client()
-        return await db.get_transaction_history(user_id, limit, offset)
+        return await db.get_transaction_history(user_id, limit, offset, before, before_id)
     except Exception as e:
         logger.error(f"Error getting transaction history for user {user_id}: {e}")
         # Return empty list for graceful degradation
         logger.warning(f"Using empty transaction history for user {user_id} due to database error")
         return []
 
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
 async def validate_balance_integrity(user_id: str) -> Dict[str, Any]:
     """Validate balance integrity using async PostgreSQL with retry logic"""
     try:
@@ -85,7 +213,7 @@ async def validate_balance_integrity(user_id: str) -> Dict[str, Any]:
         logger.error(f"Error validating balance integrity for user {user_id}: {e}")
         raise
 
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
 async def create_user_balance(user_id: str, initial_balance: float = 0.0) -> bool:
     """Create initial balance for new user using async PostgreSQL with retry logic"""
     try:
@@ -95,7 +223,7 @@ async def create_user_balance(user_id: str, initial_balance: float = 0.0) -> boo
         logger.error(f"Error creating balance for user {user_id}: {e}")
         raise
 
-@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0)
+@retry_with_exponential_backoff(max_attempts=3, base_delay=1.0, retry_exceptions=TRANSIENT_DB_ERRORS)
 async def get_user_stats(user_id: str) -> Dict[str, Any]:
     """Get user statistics using async PostgreSQL with retry logic"""
     try:
@@ -105,6 +233,28 @@ async def get_user_stats(user_id: str) -> Dict[str, Any]:
         logger.error(f"Error getting stats for user {user_id}: {e}")
         raise
 
+# Dummy prices per token, adjust per model
+BASE_PRICES = {
+    "gpt-4": 0.00003,
+    "gpt-3.5-turbo": 0.000002,
+    "claude-3": 0.000015,
+    "gemini-1.5-pro": 0.0000125
+}
+DEFAULT_PRICE_PER_TOKEN = 0.00002
+
+def _tokens_cost(model: str, tokens: int) -> float:
+    """Cost of a token count for the model, including markup"""
+    base_cost = tokens * BASE_PRICES.get(model, DEFAULT_PRICE_PER_TOKEN)
+    return base_cost + base_cost * settings.lite_llm_markup
+
+def prompt_cost(request) -> float:
+    """Estimated cost of a request's prompt (ChatCompletionRequest)"""
+    return _tokens_cost(request.model, request.estimated_prompt_tokens)
+
+def completion_cost(model: str, completion_tokens: int) -> float:
+    """Cost of generated tokens, e.g. accumulated across a stream"""
+    return _tokens_cost(model, completion_tokens)
+
 # Estimated cost function (simplified, based on tokens estimate)
 def estimate_cost(request_or_model, response_or_tokens=None) -> float:
     """
@@ -118,36 +268,10 @@ def estimate_cost(request_or_model, response_or_tokens=None) -> float:
     
     # Handle ChatCompletionRequest input
     if isinstance(request_or_model, ChatCompletionRequest):
-        request = request_or_model
-        model = request.model
-        
-        # Estimate tokens from messages (rough approximation)
-        total_tokens = 0
-        for message in request.messages:
-            # Rough token estimation: ~4 characters per token
-            total_tokens += len(message.content) // 4
-        
-        # Add some overhead for system messages and formatting
-        total_tokens += len(request.messages) * 10
-        
-    else:
-        # Handle direct model and token count
-        model = request_or_model
-        total_tokens = response_or_tokens or 1000  # Default fallback
-    
-    # Dummy prices, adjust per model
-    base_prices = {
-        "gpt-4": 0.00003,
-        "gpt-3.5-turbo": 0.000002,
-        "claude-3": 0.000015,
-        "gemini-1.5-pro": 0.0000125
-    }
-    
-    price_per_token = base_prices.get(model, 0.00002)  # Default fallback
-    base_cost = total_tokens * price_per_token
-    markup_cost = base_cost * settings.lite_llm_markup
+        return prompt_cost(request_or_model)
     
-    return base_cost + markup_cost
+    # Handle direct model and token count
+    return _tokens_cost(request_or_model, response_or_tokens or 1000)  # Default fallback
 
 # Legacy sync functions for backward compatibility (deprecated)
 def get_balance_sync(user_id: str) -> float:
@@ -1,6 +1,7 @@
 import litellm  # type: ignore
 from app.config import get_settings
 from app.monitoring.callbacks import track_cost_callback, start_llm_tracking, end_llm_tracking
+import asyncio
 import os
 import time
 import logging
@@ -24,6 +25,9 @@ litellm.success_callback = [track_cost_callback]  # From monitoring
 # Get settings instance
 settings = get_settings()
 
+# Caps in-flight provider calls so a burst cannot exhaust downstream pools
+_llm_semaphore = asyncio.Semaphore(settings.max_concurrent_llm_requests)
+
 # Set the correct env var for Gemini AI Studio
 if settings.google_gemini_api_key:
     os.environ["GEMINI_API_KEY"] = settings.google_gemini_api_key
@@ -91,6 +95,42 @@ router = litellm.Router(
     set_verbose=True
 )
 
+class _SemaphoreStream:
+    """Async iterator over a provider stream that frees its _llm_semaphore slot once"""
+    
+    def __init__(self, stream):
+        self._released = False
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            # StopAsyncIteration, a provider error or cancellation all end the stream
+            self._release()
+            raise
+    
+    async def aclose(self):
+        """Release the slot and close the provider stream (client disconnects included)"""
+        self._release()
+        close = getattr(self._stream, "aclose", None)
+        if close is not None:
+            await close()
+    
+    def _release(self):
+        if not self._released:
+            self._released = True
+            _llm_semaphore.release()
+    
+    def __del__(self):
+        # Releasing from a finalizer is not deterministic, so only report the leak
+        if not self._released:
+            logger.warning("LLM stream was dropped without aclose(); its concurrency slot is not released")
+
 async def _call_llm_internal(model: str, messages: list, stream: bool = False, user_id: str = "unknown"):
     """Internal function for LLM call without retry logic"""
     start_time = time.time()
@@ -106,12 +146,23 @@ async def _call_llm_internal(model: str, messages: list, stream: bool = False, u
             "request_id": request_id
         }
         
-        response = await router.acompletion(
-            model=model, 
-            messages=messages, 
-            stream=stream,
-            **kwargs
-        )
+        await _llm_semaphore.acquire()
+        handed_off = False
+        try:
+            response = await router.acompletion(
+                model=model, 
+                messages=messages, 
+                stream=stream,
+                **kwargs
+            )
+            if stream:
+                # A stream holds its provider connection until the last chunk;
+                # the caller must aclose() it, which releases the slot
+                response = _SemaphoreStream(response)
+                handed_off = True
+        finally:
+            if not handed_off:
+                _llm_semaphore.release()
         
         processing_time = time.time() - start_time
         logger.info(f"LLM call successful for model {model} in {processing_time:.2f}s")
@@ -0,0 +1,33 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+from functools import wraps
+
+T = TypeVar('T')
+
+def async_ttl_cache(ttl: float = 2.0):
+    """Декоратор: кэширует результат async-функции без аргументов на ttl секунд"""
+    def decorator(func: Callable[[], Awaitable[T]]) -> Callable[[], Awaitable[T]]:
+        # Entry and lock belong to this decorated function only: (expires_at, result)
+        cached: Optional[Tuple[float, T]] = None
+        lock = asyncio.Lock()
+
+        @wraps(func)
+        async def wrapper() -> T:
+            nonlocal cached
+            entry = cached
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+
+            # Single-flight: concurrent callers wait for one refresh
+            async with lock:
+                entry = cached
+                if entry is not None and entry[0] > time.monotonic():
+                    return entry[1]
+                result = await func()
+                cached = (time.monotonic() + ttl, result)
+                return result
+
+        return wrapper
+
+    return decorator
@@ -3,7 +3,7 @@
   -- Table: balances
   CREATE TABLE balances (
       user_id UUID PRIMARY KEY,
-      balance DECIMAL NOT NULL DEFAULT 0
+      balance DECIMAL NOT NULL DEFAULT 0 CHECK (balance >= 0)
   );
 
   -- Table: transactions
@@ -13,9 +13,19 @@
       amount DECIMAL NOT NULL,
       type TEXT NOT NULL,
       timestamp TIMESTAMP DEFAULT NOW(),
-      description TEXT
+      description TEXT,
+      -- Part of a deferred debit the balance could not cover (amount holds
+      -- what was charged). Existing databases:
+      -- ALTER TABLE transactions ADD COLUMN unpaid DECIMAL NOT NULL DEFAULT 0;
+      unpaid DECIMAL NOT NULL DEFAULT 0
   );
 
+  -- Index: newest-first transaction history per user. INCLUDE makes the
+  -- history query an index-only scan. On an existing database run it as
+  -- CREATE INDEX CONCURRENTLY to avoid locking writes.
+  CREATE INDEX idx_transactions_user_timestamp ON transactions (user_id, timestamp DESC, id DESC)
+      INCLUDE (amount, unpaid, type, description);
+
   -- Enable RLS on balances
   ALTER TABLE balances ENABLE ROW LEVEL SECURITY;
 